@@ -0,0 +1,52 @@
+import time
+
+import numpy as np
+import torch
+
+import ppg_con
+
+def make_agent(module, state_dim, action_dim):
+    return module.Agent(state_dim, action_dim, True, 0.03, 5, 2.0, 0.0, 1.0, 32, 10, 0.99, 0.95, 3e-4, 1024, 5)
+
+def original_act(agent, state):
+    # What act did before the inference path: a fresh tensor for every step, both networks with autograd on,
+    # a Normal to sample from and another one for the log probability
+    device          = agent.policy_flat.data.device
+    state           = torch.FloatTensor(state).unsqueeze(0).to(device)
+    action_mean, _  = agent.policy(state)
+    value           = agent.value(state)
+
+    action  = agent.distributions.sample(action_mean, agent.std)
+    logprob = agent.distributions.logprob(action_mean, agent.std, action)
+    return action.squeeze(0).cpu().numpy(), action_mean.squeeze(0).detach().cpu().numpy(), logprob.squeeze(0).detach().cpu().numpy(), value.item()
+
+def measure(act, states):
+    act(states[0]) # Warm up
+
+    start = time.perf_counter()
+    for state in states:
+        act(state)
+
+    return (time.perf_counter() - start) / len(states)
+
+def main():
+    ############## Hyperparameters ##############
+    n_step              = 2000 # How many steps are timed
+    #############################################
+    configs = [
+        ('BipedalWalker', ppg_con, 24, 4)
+    ]
+
+    for name, module, state_dim, action_dim in configs:
+        agent   = make_agent(module, state_dim, action_dim)
+
+        states  = np.random.randn(n_step, state_dim).astype(np.float32)
+
+        original_time   = measure(lambda state: original_act(agent, state), states)
+        act_time        = measure(agent.act, states)
+
+        print('{} \t original act: {:.1f} us \t inference act: {:.1f} us \t speedup: {:.2f}x'.format(
+            name, original_time * 1e6, act_time * 1e6, original_time / act_time))
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,16 @@ import torch
 import torch.nn as nn
 from torch.distributions import Normal
 from torch.distributions.kl import kl_divergence
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 from torch.optim import Adam
 
 import matplotlib.pyplot as plt
 import numpy as np
 import sys
 import numpy
+import threading
 import time
+from queue import Queue
 import datetime
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")  
@@ -67,60 +69,491 @@ class Value_Model(nn.Module):
     def forward(self, states):
         return self.nn_layer(states)
 
+class FlatParameters():
+    # Every parameter of the model is a view into one contiguous buffer, and so are the Adam moments of them.
+    # Copying the weights into another model, to the runners or into a checkpoint is then a single tensor
+    def __init__(self, model, optimizer = None):
+        self.model      = model
+        self.optimizer  = optimizer
+        self.params     = list(model.parameters())
+        self.numels     = [param.numel() for param in self.params]
+
+        self.data       = torch.cat([param.data.reshape(-1) for param in self.params])
+        for param, data in zip(self.params, self.views(self.data)):
+            param.data  = data
+
+        self.steps, self.exp_avg, self.exp_avg_sq = None, None, None
+        if optimizer is not None:
+            # Adam only creates its state on the first step, so views are put there before it does
+            self.steps      = [torch.tensor(0.0) for _ in self.params]
+            self.exp_avg    = torch.zeros_like(self.data)
+            self.exp_avg_sq = torch.zeros_like(self.data)
+
+            for param, step, exp_avg, exp_avg_sq in zip(self.params, self.steps, self.views(self.exp_avg), self.views(self.exp_avg_sq)):
+                optimizer.state[param] = {'step': step, 'exp_avg': exp_avg, 'exp_avg_sq': exp_avg_sq}
+
+    def views(self, datas):
+        return [data.view_as(param) for data, param in zip(datas.split(self.numels), self.params)]
+
+    def copy_(self, data):
+        # An agent.pth from before the flat buffer holds the state dict of the model
+        if isinstance(data, dict):
+            self.model.load_state_dict(data)
+        else:
+            self.data.copy_(data)
+
+    def state_dict(self):
+        if self.steps is None:
+            return {'params': self.data}
+
+        return {'params': self.data, 'steps': torch.stack(self.steps), 'exp_avg': self.exp_avg, 'exp_avg_sq': self.exp_avg_sq}
+
+    def load_state_dict(self, state_dict):
+        if 'model_state_dict' in state_dict:
+            self.load_legacy_state_dict(state_dict)
+            return
+
+        self.data.copy_(state_dict['params'])
+
+        if self.steps is not None and 'steps' in state_dict:
+            for step, saved in zip(self.steps, state_dict['steps']):
+                step.copy_(saved)
+
+            self.exp_avg.copy_(state_dict['exp_avg'])
+            self.exp_avg_sq.copy_(state_dict['exp_avg_sq'])
+
+    def load_legacy_state_dict(self, state_dict):
+        # Checkpoints from before the flat buffers hold the state dicts of the model and of its optimizer.
+        # The model copies into the parameters in place, which are views of data already
+        self.model.load_state_dict(state_dict['model_state_dict'])
+
+        if self.steps is None or 'optimizer_state_dict' not in state_dict:
+            return
+
+        # The optimizer puts new tensors into its state, so they are copied back into the flat buffers
+        # and the state points at the views again
+        self.optimizer.load_state_dict(state_dict['optimizer_state_dict'])
+        for param, step, exp_avg, exp_avg_sq in zip(self.params, self.steps, self.views(self.exp_avg), self.views(self.exp_avg_sq)):
+            saved = self.optimizer.state.get(param, {})
+            if 'exp_avg' in saved:
+                step.fill_(float(saved['step']))
+                exp_avg.copy_(saved['exp_avg'])
+                exp_avg_sq.copy_(saved['exp_avg_sq'])
+
+            self.optimizer.state[param] = {'step': step, 'exp_avg': exp_avg, 'exp_avg_sq': exp_avg_sq}
+
+class FusedActorCritic():
+    # The actor of Policy_Model and Value_Model side by side in one chain of matmuls for acting.
+    # Both read the same states, so their first layers are stacked into one matrix and the later ones
+    # are joined block diagonally. It holds copies of the weights, so sync is called after they are trained
+    def __init__(self, policy, value = None, capacity = 1):
+        self.policy_layers  = [policy.nn_layer[0], policy.nn_layer[2], policy.actor_layer[0]]
+        self.value_layers   = [value.nn_layer[0], value.nn_layer[2], value.nn_layer[4]] if value is not None else []
+        self.activation     = policy.actor_layer[1]
+        self.action_dim     = self.policy_layers[-1].out_features
+        self.state_dim      = self.policy_layers[0].in_features
+
+        weight              = self.policy_layers[0].weight
+        self.weights        = []
+        self.biases         = []
+
+        for i, policy_layer in enumerate(self.policy_layers):
+            in_features     = self.state_dim if i == 0 else self.weights[-1].shape[1]
+            out_features    = policy_layer.out_features + (self.value_layers[i].out_features if value is not None else 0)
+
+            self.weights.append(torch.zeros((in_features, out_features), dtype = weight.dtype, device = weight.device))
+            self.biases.append(torch.zeros(out_features, dtype = weight.dtype, device = weight.device))
+
+        self.allocate(capacity)
+        self.sync()
+
+    def allocate(self, capacity):
+        # The input and the output of every layer are written into these, only a bigger batch allocates again.
+        # They are made outside of inference mode, so act can grow them and the plain forward pass can still write them
+        weight          = self.weights[0]
+        self.capacity   = capacity
+        with torch.inference_mode(False):
+            self.inputs     = torch.zeros((capacity, self.state_dim), dtype = weight.dtype, device = weight.device)
+            self.outputs    = [torch.zeros((capacity, weight.shape[1]), dtype = weight.dtype, device = weight.device) for weight in self.weights]
+
+    def sync(self):
+        # Copies the current weights in, the blocks off the diagonal stay zero
+        with torch.no_grad():
+            for i, policy_layer in enumerate(self.policy_layers):
+                in_features, out_features = policy_layer.in_features, policy_layer.out_features
+
+                self.weights[i][:in_features, :out_features].copy_(policy_layer.weight.t())
+                self.biases[i][:out_features].copy_(policy_layer.bias)
+
+                if self.value_layers:
+                    # The first layers of both read the states, the later ones only their own part of the layer before
+                    value_layer = self.value_layers[i]
+                    rows        = 0 if i == 0 else in_features
+
+                    self.weights[i][rows:, out_features:].copy_(value_layer.weight.t())
+                    self.biases[i][out_features:].copy_(value_layer.bias)
+
+    def __call__(self, states):
+        # Returns the actor output and the values of states, the values are None without a value network
+        states  = torch.as_tensor(np.asarray(states, dtype = np.float32)).reshape(-1, self.state_dim)
+        n       = len(states)
+
+        if n > self.capacity:
+            self.allocate(n)
+
+        datas = self.inputs[:n]
+        datas.copy_(states)
+
+        for i, (weight, bias, outputs) in enumerate(zip(self.weights, self.biases, self.outputs)):
+            datas = torch.addmm(bias, datas, weight, out = outputs[:n])
+            if i < len(self.weights) - 1:
+                datas.relu_()
+
+        # The buffers are written again by the next call, so the values are copied out
+        values = datas[:, self.action_dim:].clone() if self.value_layers else None
+        return self.activation(datas[:, :self.action_dim]), values
+
+class NextStates():
+    # next_state[t] is the state in row t + 1, except for a step that ends a segment without done.
+    # Only those boundary steps keep their own next state, so every observation is stored once
+    def __init__(self, states, slots, boundaries):
+        self.states     = states # The rows after each step, at least the last one that follows the final step
+        self.slots      = slots # Row in boundaries for a step that ends a segment, otherwise -1
+        self.boundaries = boundaries
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, _  = idx.indices(len(self))
+            next_states     = self.states[start + 1 : stop + 1]
+        else:
+            next_states     = self.states[idx + 1]
+
+        # Only a minibatch that holds the end of a segment is copied
+        slots   = self.slots[idx]
+        ends    = slots >= 0
+        if ends.any():
+            next_states         = next_states.clone()
+            next_states[ends]   = self.boundaries[slots[ends]]
+
+        return next_states
+
 class PolicyMemory(Dataset):
-    def __init__(self):
-        self.actions        = [] 
-        self.states         = []
-        self.rewards        = []
-        self.dones          = []     
-        self.next_states    = []
+    def __init__(self, state_dim, action_dim, capacity = 1024, states = None):
+        self.size           = 0
+
+        self.actions        = np.zeros((capacity, action_dim), dtype = np.float32)
+        self.action_means   = np.zeros((capacity, action_dim), dtype = np.float32) # The policy's output when it acted, the old policy at the update
+        self.logprobs       = np.zeros((capacity, action_dim), dtype = np.float32)
+        self.values         = np.zeros((capacity, 1), dtype = np.float32)
+        self.states         = states if states is not None else np.zeros((capacity + 1, state_dim), dtype = np.float32) # The spare row holds the next state of the last step
+        self.rewards        = np.zeros((capacity, 1), dtype = np.float32)
+        self.dones          = np.zeros((capacity, 1), dtype = bool)
+        self.slots          = np.full(capacity, -1, dtype = np.int64)
+        self.boundaries     = []
 
     def __len__(self):
-        return len(self.dones)
+        return self.size
 
     def __getitem__(self, idx):
-        return np.array(self.states[idx], dtype = np.float32), np.array(self.actions[idx], dtype = np.float32), \
-            np.array([self.rewards[idx]], dtype = np.float32), np.array([self.dones[idx]], dtype = np.float32), np.array(self.next_states[idx], dtype = np.float32)      
+        next_state = self.boundaries[self.slots[idx]] if self.slots[idx] >= 0 else self.states[idx + 1]
+        return self.states[idx], self.actions[idx], self.action_means[idx], self.logprobs[idx], self.values[idx], self.rewards[idx], self.dones[idx], next_state
 
     def get_all(self):
-        return self.states, self.actions, self.rewards, self.dones, self.next_states        
+        # Only the state after the final step is sent along with the boundaries, the rest are already in states
+        return self.states[:self.size], self.actions[:self.size], self.action_means[:self.size], self.logprobs[:self.size], self.values[:self.size], \
+            self.rewards[:self.size], self.dones[:self.size], NextStates(self.states[self.size : self.size + 1], self.slots[:self.size], self.get_boundaries())
+
+    def get_all_tensor(self):
+        # torch.from_numpy shares the buffer, so these are views and not copies
+        states, actions, action_means, logprobs, values, rewards, dones, next_states = self.get_all()
+        next_states = NextStates(torch.from_numpy(self.states[:self.size + 1]), torch.from_numpy(next_states.slots), torch.from_numpy(next_states.boundaries))
+
+        return torch.from_numpy(states), torch.from_numpy(actions), torch.from_numpy(action_means), torch.from_numpy(logprobs), torch.from_numpy(values), \
+            torch.from_numpy(rewards), torch.from_numpy(dones), next_states
+
+    def get_boundaries(self):
+        return np.array(self.boundaries, dtype = self.states.dtype).reshape((-1,) + self.states.shape[1:])
     
-    def save_all(self, states, actions, rewards, dones, next_states):
-        self.actions = self.actions + actions
-        self.states = self.states + states
-        self.rewards = self.rewards + rewards
-        self.dones = self.dones + dones
-        self.next_states = self.next_states + next_states
+    def save_all(self, states, actions, action_means, logprobs, values, rewards, dones, next_states):
+        if len(dones) == 0:
+            return
+
+        start, end = self.reserve(len(dones))
+        self.split(start, states[0])
+
+        self.actions[start:end]         = np.reshape(actions, (end - start, -1))
+        self.action_means[start:end]    = np.reshape(action_means, (end - start, -1))
+        self.logprobs[start:end]        = np.reshape(logprobs, (end - start, -1))
+        self.values[start:end]          = np.reshape(values, (-1, 1))
+        self.states[start:end]          = states
+        self.states[end]                = next_states.states[-1]
+        self.rewards[start:end]         = np.reshape(rewards, (-1, 1))
+        self.dones[start:end]           = np.reshape(dones, (-1, 1))
+        self.slots[start:end]           = np.where(next_states.slots < 0, -1, next_states.slots + len(self.boundaries))
+
+        self.boundaries.extend(next_states.boundaries)
     
-    def save_eps(self, state, action, reward, done, next_state):
-        self.rewards.append(reward)
-        self.states.append(state)
-        self.actions.append(action)
-        self.dones.append(done)
-        self.next_states.append(next_state)
+    def save_eps(self, state, action, action_mean, logprob, value, reward, done, next_state, reset = None):
+        idx, _ = self.reserve(1)
+        self.split(idx, state, reset)
+
+        self.actions[idx]       = action
+        self.action_means[idx]  = action_mean
+        self.logprobs[idx]      = logprob
+        self.values[idx]        = value
+        self.states[idx]        = state
+        self.states[idx + 1]    = next_state
+        self.rewards[idx]       = reward
+        self.dones[idx]         = done
+        self.slots[idx]         = -1
+
+    def clear_memory(self, states = None):
+        # The aux memory keeps the filled states, so the next rollout is written into the storage it hands back
+        if states is not None:
+            self.states = states
+
+        self.size = 0
+        del self.boundaries[:]
+
+    def capacity(self):
+        return len(self.dones)
 
-    def clear_memory(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.rewards[:]
-        del self.dones[:]
-        del self.next_states[:]  
+    def reserve(self, n):
+        start       = self.size
+        self.size   = start + n
+
+        # Only grows when a rollout is longer than the preallocated capacity
+        if self.size > self.capacity():
+            self.resize(max(self.size, 2 * self.capacity()))
+
+        return start, self.size
+
+    def split(self, idx, state, reset = None):
+        # A step that does not go on from the one before means that one ended a segment,
+        # so its next state is moved out of the row the new step is written into.
+        # Without a reset flag from the runner it is told by the state, compared in the dtype the rows are stored in
+        if reset is None:
+            reset = not np.array_equal(self.states[idx], np.asarray(state, dtype = self.states.dtype))
+
+        if idx > 0 and not self.dones[idx - 1] and reset:
+            self.slots[idx - 1] = len(self.boundaries)
+            self.boundaries.append(self.states[idx].copy())
+
+    def resize(self, capacity):
+        # states keeps its spare row
+        extra = capacity - self.capacity()
+
+        for name in ['actions', 'action_means', 'logprobs', 'values', 'states', 'rewards', 'dones', 'slots']:
+            datas       = getattr(self, name)
+            new_datas   = np.zeros((len(datas) + extra,) + datas.shape[1:], dtype = datas.dtype)
+
+            new_datas[:len(datas)] = datas
+            setattr(self, name, new_datas)
 
 class AuxMemory(Dataset):
-    def __init__(self):
-        self.states = []
+    def __init__(self, state_dim, capacity = 5120):
+        self.size       = 0
+        self.cursor     = 0
+        self.start      = 0
+        self.contiguous = True
+
+        self.storage    = np.zeros((capacity, state_dim), dtype = np.float32)
+        self.chunks     = []
 
     def __len__(self):
-        return len(self.states)
+        return self.size
 
     def __getitem__(self, idx):
-        return np.array(self.states[idx], dtype = np.float32)
+        return self.get_all()[idx]
+
+    def next_chunk(self, n):
+        # The policy memory writes its next phase straight into this slice of the storage.
+        # It starts over from the beginning once the aux cycle has been consumed
+        if len(self.chunks) == 0 or self.cursor + n > len(self.storage):
+            self.cursor = 0
+
+        if n <= len(self.storage) and self.is_free(self.cursor, n):
+            return self.storage[self.cursor : self.cursor + n]
+
+        # The storage is still held by chunks of this aux cycle, so the phase gets its own buffer
+        return np.zeros((n, self.storage.shape[1]), dtype = np.float32)
+
+    def get_all(self):
+        if len(self.chunks) == 1:
+            return self.chunks[0]
+
+        if self.contiguous:
+            return self.storage[self.start : self.start + self.size]
+
+        return np.concatenate(self.chunks)
+
+    def get_all_tensor(self):
+        return torch.from_numpy(self.get_all())
 
     def save_all(self, states):
-        self.states = self.states + states
+        # Only a reference to the chunk is kept, the states are never copied here
+        if len(states) == 0:
+            return
+
+        offset = self.offset(states)
+
+        if len(self.chunks) == 0:
+            self.start      = offset
+            self.contiguous = offset is not None
+        else:
+            self.contiguous = self.contiguous and offset == self.start + self.size
+
+        if offset == self.cursor:
+            self.cursor += len(states)
+
+        self.chunks.append(states)
+        self.size += len(states)
 
     def clear_memory(self):
-        del self.states[:]
+        self.size = 0
+        del self.chunks[:]
+
+    def is_free(self, start, n):
+        for chunk in self.chunks:
+            offset = self.offset(chunk)
+            if offset is not None and start < offset + len(chunk) and offset < start + n:
+                return False
+
+        return True
+
+    def offset(self, states):
+        # Row of the storage where states begins, or None if states was not handed out by next_chunk
+        if len(states) == 0 or not np.may_share_memory(states, self.storage):
+            return None
+
+        return (states.ctypes.data - self.storage.ctypes.data) // self.storage.strides[0]
+
+class MinibatchSampler():
+    def __init__(self, batchsize, shuffle = False):
+        self.batchsize  = batchsize
+        self.shuffle    = shuffle
+
+    def sample(self, n):
+        # Yields slices, or chunks of one index permutation when shuffling,
+        # so each minibatch is gathered from the whole tensors in a single indexing op
+        if self.shuffle:
+            indices = torch.randperm(n)
+            for start in range(0, n, self.batchsize):
+                yield indices[start : start + self.batchsize]
+
+        else:
+            for start in range(0, n, self.batchsize):
+                yield slice(start, start + self.batchsize)
+
+class MinibatchPrefetcher():
+    def __init__(self, sampler, device, depth = 2):
+        self.sampler    = sampler
+        self.device     = device
+        self.depth      = depth # How many minibatches are assembled ahead of the training step
+
+        self.pinned     = device.type == 'cuda'
+        self.stream     = torch.cuda.Stream(device) if self.pinned else None
+        self.consumer   = None
+        self.key        = None
+        self.slots      = []
+
+        self.fetch_time = 0.0
+        self.wait_time  = 0.0
+        self.overlap    = 0.0 # Share of the time spent assembling minibatches that was hidden behind training
+
+    def prefetch(self, datas, expands = None):
+        # Yields the minibatches of datas on the device while a background thread gathers, converts and copies the next ones.
+        # A field with an expand function keeps its own dtype and is expanded after the copy, the others become float32
+        expands = expands if expands is not None else (None,) * len(datas)
+        self.allocate(datas, expands)
+
+        queue           = Queue(self.depth)
+        self.consumer   = torch.cuda.current_stream(self.device) if self.pinned else None
+        self.fetch_time = 0.0
+        self.wait_time  = 0.0
+
+        thread = threading.Thread(target = self.produce, args = (queue, datas, expands), daemon = True)
+        thread.start()
+
+        while True:
+            start           = time.perf_counter()
+            batch           = queue.get()
+            self.wait_time  += time.perf_counter() - start
+
+            if batch is None:
+                break
+
+            if isinstance(batch, Exception):
+                raise batch
+
+            batch, event = batch
+            if event is not None:
+                self.consumer.wait_event(event)
+
+            yield batch
+
+        thread.join()
+        self.overlap = 1.0 - min(self.wait_time / self.fetch_time, 1.0) if self.fetch_time > 0 else 0.0
+
+    def produce(self, queue, datas, expands):
+        try:
+            for i, idx in enumerate(self.sampler.sample(len(datas[0]))):
+                start           = time.perf_counter()
+                batch           = self.fetch(self.slots[i % len(self.slots)], datas, expands, idx)
+                self.fetch_time += time.perf_counter() - start
+
+                queue.put(batch)
+
+            queue.put(None)
+
+        except Exception as e:
+            queue.put(e)
+
+    def fetch(self, slot, datas, expands, idx):
+        buffers, event = slot
+
+        # The staging buffers of a slot are reused only after the copies out of them are done
+        if event is not None:
+            event.synchronize()
+
+        staged = []
+        for buffer, data in zip(buffers, datas):
+            rows = data[idx]
+            staged.append(buffer[:len(rows)].copy_(rows))
+
+        if self.stream is None:
+            staged = [datas.to(self.device) for datas in staged]
+            return tuple(expand(datas) if expand is not None else datas for datas, expand in zip(staged, expands)), None
+
+        with torch.cuda.stream(self.stream):
+            batch = []
+            for datas, expand in zip(staged, expands):
+                datas = datas.to(self.device, non_blocking = True)
+                datas = expand(datas) if expand is not None else datas
+
+                datas.record_stream(self.consumer)
+                batch.append(datas)
+
+            event.record(self.stream)
+
+        return tuple(batch), event
+
+    def allocate(self, datas, expands):
+        # One set of staging buffers for each minibatch that can be in flight: queued, being trained on and being filled
+        samples = [data[0:1] for data in datas]
+        key     = tuple((sample.shape[1:], sample.dtype if expand is not None else torch.float32) for sample, expand in zip(samples, expands))
+
+        if key == self.key:
+            return
+
+        self.key    = key
+        self.slots  = []
+        for _ in range(self.depth + 2):
+            buffers = tuple(torch.empty((self.sampler.batchsize,) + shape, dtype = dtype, pin_memory = self.pinned) for shape, dtype in key)
+            self.slots.append((buffers, torch.cuda.Event() if self.pinned else None))
 
 class Continous():
     def sample(self, mean, std):
@@ -141,35 +574,69 @@ class Continous():
 
         return kl_divergence(distribution1, distribution2).float().to(device)  
 
+class ContinousSampler():
+    # Draws the actions of act as mean + std * noise, without a Normal on every step.
+    # The noise goes into a buffer that is kept between steps, and the log probability is taken from the noise
+    def __init__(self, std, capacity = 1):
+        self.std        = std
+        self.log_std    = std.log() + 0.5 * np.log(2 * np.pi)
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        # Made outside of inference mode, so the buffer can be written in or out of it
+        with torch.inference_mode(False):
+            self.capacity   = capacity
+            self.noise      = torch.zeros((capacity, self.std.shape[1]), device = self.std.device)
+
+    def sample(self, action_mean, training_mode = True):
+        n = len(action_mean)
+        if n > self.capacity:
+            self.allocate(n)
+
+        # The mean itself is the action in Test Mode, which is the same as no noise
+        noise       = self.noise[:n].normal_() if training_mode else self.noise[:n].zero_()
+
+        # log N(mean + std * noise | mean, std) = -noise^2 / 2 - log(std) - log(2 pi) / 2
+        actions     = torch.addcmul(action_mean, noise, self.std)
+        logprobs    = noise.square().mul_(-0.5).sub_(self.log_std)
+        return actions, logprobs
+
 class PolicyFunction():
     def __init__(self, gamma = 0.99, lam = 0.95):
         self.gamma  = gamma
         self.lam    = lam
 
+    def backward_scan(self, datas, factors):
+        # Solves y[t] = datas[t] + factors[t] * y[t + 1] for every step at once.
+        # Each pass folds in the steps twice as far ahead, so a rollout takes log2(n) passes instead of n
+        shift = 1
+        while shift < len(datas):
+            datas   = torch.cat([datas[:-shift] + factors[:-shift] * datas[shift:], datas[-shift:]])
+            factors = torch.cat([factors[:-shift] * factors[shift:], factors[-shift:]])
+            shift   *= 2
+
+        return datas
+
     def monte_carlo_discounted(self, rewards, dones):
-        running_add = 0
-        returns     = []        
-        
-        for step in reversed(range(len(rewards))):
-            running_add = rewards[step] + (1.0 - dones[step]) * self.gamma * running_add
-            returns.insert(0, running_add)
-            
-        return torch.stack(returns)
+        return self.backward_scan(rewards, (1.0 - dones) * self.gamma)
       
     def temporal_difference(self, reward, next_value, done):
         q_values = reward + (1 - done) * self.gamma * next_value           
         return q_values
       
-    def generalized_advantage_estimation(self, values, rewards, next_values, dones):
-        gae     = 0
-        adv     = []     
-
-        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values          
-        for step in reversed(range(len(rewards))):
-            gae = delta[step] + (1.0 - dones[step]) * self.gamma * self.lam * gae
-            adv.insert(0, gae)
-            
-        return torch.stack(adv)
+    def generalized_advantage_estimation(self, values, rewards, next_values, dones, ends = None):
+        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values
+        factors = (1.0 - dones) * self.gamma * self.lam
+
+        # A step whose next state is not in the following row ends its segment, so its advantage does not run on into that row
+        if ends is not None:
+            factors = factors.masked_fill(ends, 0.0)
+
+        return self.backward_scan(delta, factors)
+
+    def lambda_returns(self, values, rewards, next_values, dones):
+        # TD(lambda) targets, the value plus its GAE advantage
+        return self.generalized_advantage_estimation(values, rewards, next_values, dones) + values
 
 class TrulyPPO():
     def __init__(self, policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam):
@@ -182,19 +649,22 @@ class TrulyPPO():
         self.distributions      = Continous()
         self.policy_function    = PolicyFunction(gamma, lam)
 
-    def compute_loss(self, action_mean, action_std, old_action_mean, old_action_std, values, old_values, next_values, actions, rewards, dones):    
+    def compute_targets(self, values, next_values, rewards, dones, ends):
+        # Getting general advantages estimator and returns of the whole rollout
+        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones, ends)
+        Returns         = Advantages + values
+        Advantages      = (Advantages - Advantages.mean()) / (Advantages.std() + 1e-6)
+
+        return Advantages, Returns
+
+    def compute_loss(self, action_mean, action_std, old_action_mean, old_action_std, old_logprobs, values, old_values, actions, Advantages, Returns):    
         # Don't use old value in backpropagation
         Old_values          = old_values.detach()
         Old_action_mean     = old_action_mean.detach()
 
-        # Getting general advantages estimator and returns
-        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones)
-        Returns         = (Advantages + values).detach()
-        Advantages      = ((Advantages - Advantages.mean()) / (Advantages.std() + 1e-6)).detach() 
-
         # Finding the ratio (pi_theta / pi_theta__old):      
         logprobs        = self.distributions.logprob(action_mean, action_std, actions)
-        Old_logprobs    = self.distributions.logprob(Old_action_mean, old_action_std, actions).detach() 
+        Old_logprobs    = old_logprobs.detach()
 
         # Finding Surrogate Loss
         ratios          = (logprobs - Old_logprobs).exp() # ratios = old_logprobs / logprobs        
@@ -240,7 +710,7 @@ class JointAux():
 
 class Agent():  
     def __init__(self, state_dim, action_dim, is_training_mode, policy_kl_range, policy_params, value_clip, entropy_coef, vf_loss_coef,
-                 batchsize, PPO_epochs, gamma, lam, learning_rate):        
+                 batchsize, PPO_epochs, gamma, lam, learning_rate, n_update, n_aux_update):        
         self.policy_kl_range    = policy_kl_range 
         self.policy_params      = policy_params
         self.value_clip         = value_clip    
@@ -253,20 +723,26 @@ class Agent():
         self.std                = torch.ones([1, action_dim]).float().to(device)
 
         self.policy             = Policy_Model(state_dim, action_dim)
-        self.policy_old         = Policy_Model(state_dim, action_dim)
         self.policy_optimizer   = Adam(self.policy.parameters(), lr = learning_rate)
+        self.policy_flat        = FlatParameters(self.policy, self.policy_optimizer)
 
         self.value              = Value_Model(state_dim, action_dim)
-        self.value_old          = Value_Model(state_dim, action_dim)
         self.value_optimizer    = Adam(self.value.parameters(), lr = learning_rate)
+        self.value_flat         = FlatParameters(self.value, self.value_optimizer)
+        self.fused              = FusedActorCritic(self.policy, self.value)
 
-        self.policy_memory      = PolicyMemory()
-        self.policy_loss        = TrulyPPO(policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam)
+        rollout_size            = n_update if n_update is not None else 1024
 
-        self.aux_memory         = AuxMemory()
+        self.aux_memory         = AuxMemory(state_dim, rollout_size * n_aux_update + 1)
         self.aux_loss           = JointAux()
+        self.sampler            = MinibatchSampler(batchsize)
+        self.prefetcher         = MinibatchPrefetcher(self.sampler, device)
+
+        self.policy_memory      = PolicyMemory(state_dim, action_dim, rollout_size, self.aux_memory.next_chunk(rollout_size + 1))
+        self.policy_loss        = TrulyPPO(policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam)
          
         self.distributions      = Continous()
+        self.action_sampler     = ContinousSampler(self.std)
 
         if is_training_mode:
           self.policy.train()
@@ -275,32 +751,54 @@ class Agent():
           self.policy.eval()
           self.value.eval()
 
-    def save_eps(self, state, action, reward, done, next_state):
-        self.policy_memory.save_eps(state, action, reward, done, next_state)
+    def save_eps(self, state, action, action_mean, logprob, value, reward, done, next_state, reset = None):
+        self.policy_memory.save_eps(state, action, action_mean, logprob, value, reward, done, next_state, reset)
 
     def act(self, state):
-        state           = torch.FloatTensor(state).unsqueeze(0).to(device).detach()
-        action_mean, _  = self.policy(state)
-        
-        # We don't need sample the action in Test Mode
-        # only sampling the action in Training Mode in order to exploring the actions
-        if self.is_training_mode:
-            # Sample the action
-            action  = self.distributions.sample(action_mean, self.std)
-        else:
-            action  = action_mean  
-              
-        return action.squeeze(0).cpu().numpy()
+        with torch.inference_mode():
+            action_mean, value = self.fused(state)
+
+            # We don't need sample the action in Test Mode
+            # only sampling the action in Training Mode in order to exploring the actions
+            action, logprob    = self.action_sampler.sample(action_mean, self.is_training_mode)
+
+        # Nothing is trained until the rollout is full, so these are the old policy and value the update compares against
+        return action.squeeze(0).cpu().numpy(), action_mean.squeeze(0).cpu().numpy(), logprob.squeeze(0).cpu().numpy(), value.item()
+
+    def compute_targets(self, values, rewards, dones, next_states):
+        # The values were recorded when acting, only the state after the final step
+        # and the boundary states have no row of their own and are valued here
+        with torch.no_grad():
+            tails = self.value(torch.cat([next_states.states[-1:], next_states.boundaries]).float().to(device)).cpu()
+
+        ends                = next_states.slots >= 0
+        next_values         = torch.cat([values[1:], tails[:1]])
+        next_values[ends]   = tails[1:][next_states.slots[ends]]
+
+        advantages, returns = self.policy_loss.compute_targets(values.to(device), next_values.to(device), rewards.to(device), dones.float().to(device), ends.unsqueeze(1).to(device))
+
+        # The prefetcher gathers the minibatches on the host
+        return advantages.cpu(), returns.cpu()
+
+    def compute_aux_targets(self, states):
+        # Nothing trains the value network in the aux phase, and the old policy is the policy as the phase starts,
+        # so both are run over the aux states once instead of in every minibatch of every epoch
+        returns, old_action_means = [], []
+
+        with torch.no_grad():
+            for start in range(0, len(states), self.batchsize):
+                batch = states[start : start + self.batchsize].float().to(device)
+                returns.append(self.value(batch).cpu())
+                old_action_means.append(self.policy(batch)[0].cpu())
+
+        return torch.cat(returns), torch.cat(old_action_means)
 
     # Get loss and Do backpropagation
-    def training_ppo(self, states, actions, rewards, dones, next_states):
+    def training_ppo(self, states, actions, old_action_mean, old_logprobs, old_values, advantages, returns):
         action_mean, _      = self.policy(states)
         values              = self.value(states)
-        old_action_mean, _  = self.policy_old(states)
-        old_values          = self.value_old(states)
-        next_values         = self.value(next_states)
 
-        loss                = self.policy_loss.compute_loss(action_mean, self.std, old_action_mean, self.std, values, old_values, next_values, actions, rewards, dones)
+        loss                = self.policy_loss.compute_loss(action_mean, self.std, old_action_mean, self.std, old_logprobs, values, old_values, actions, advantages, returns)
 
         self.policy_optimizer.zero_grad()
         self.value_optimizer.zero_grad()
@@ -310,11 +808,8 @@ class Agent():
         self.policy_optimizer.step()
         self.value_optimizer.step()
 
-    def training_aux(self, states):
-        Returns                         = self.value(states).detach()
-
+    def training_aux(self, states, Returns, old_action_mean):
         action_mean, values             = self.policy(states)
-        old_action_mean, _              = self.policy_old(states)
 
         joint_loss                      = self.aux_loss.compute_loss(action_mean, self.std, old_action_mean, self.std, values, Returns)
 
@@ -324,55 +819,48 @@ class Agent():
 
     # Update the model
     def update_ppo(self):
-        dataloader  = DataLoader(self.policy_memory, self.batchsize, shuffle = False)
+        states, actions, action_means, logprobs, values, rewards, dones, next_states = self.policy_memory.get_all_tensor()
+        advantages, returns = self.compute_targets(values, rewards, dones, next_states)
 
         # Optimize policy for K epochs:
         for _ in range(self.PPO_epochs):
-            for states, actions, rewards, dones, next_states in dataloader:
-                self.training_ppo(states.float().to(device), actions.float().to(device), rewards.float().to(device), dones.float().to(device), next_states.float().to(device))
+            for batch in self.prefetcher.prefetch((states, actions, action_means, logprobs, values, advantages, returns)):
+                self.training_ppo(*batch)
 
         # Clear the memory
-        states, _, _, _, _ = self.policy_memory.get_all()
-        self.aux_memory.save_all(states)
-        self.policy_memory.clear_memory()
+        self.aux_memory.save_all(self.policy_memory.get_all()[0])
+        self.policy_memory.clear_memory(self.aux_memory.next_chunk(self.policy_memory.capacity() + 1))
 
-        # Copy new weights into old policy:
-        self.policy_old.load_state_dict(self.policy.state_dict())
-        self.value_old.load_state_dict(self.value.state_dict())
+        # act runs on a copy of the weights
+        self.fused.sync()
 
     def update_aux(self):
-        dataloader  = DataLoader(self.aux_memory, self.batchsize, shuffle = False)
+        states                      = self.aux_memory.get_all_tensor()
+        returns, old_action_means   = self.compute_aux_targets(states)
 
         # Optimize policy for K epochs:
         for _ in range(self.PPO_epochs):       
-            for states in dataloader:
-                self.training_aux(states.float().to(device))
+            for batch in self.prefetcher.prefetch((states, returns, old_action_means)):
+                self.training_aux(*batch)
 
         # Clear the memory
         self.aux_memory.clear_memory()
 
-        # Copy new weights into old policy:
-        self.policy_old.load_state_dict(self.policy.state_dict())
+        # The whole storage is free again, so the next rollout can be written into it
+        if len(self.policy_memory) == 0:
+            self.policy_memory.clear_memory(self.aux_memory.next_chunk(self.policy_memory.capacity() + 1))
+
+        self.fused.sync()
 
     def save_weights(self):
-        torch.save({
-            'model_state_dict': self.policy.state_dict(),
-            'optimizer_state_dict': self.policy_optimizer.state_dict()
-            }, 'SlimeVolley/policy.tar')
+        torch.save(self.policy_flat.state_dict(), 'SlimeVolley/policy.tar')
         
-        torch.save({
-            'model_state_dict': self.value.state_dict(),
-            'optimizer_state_dict': self.value_optimizer.state_dict()
-            }, 'SlimeVolley/value.tar')
+        torch.save(self.value_flat.state_dict(), 'SlimeVolley/value.tar')
         
     def load_weights(self):
-        policy_checkpoint = torch.load('SlimeVolley/policy.tar')
-        self.policy.load_state_dict(policy_checkpoint['model_state_dict'])
-        self.policy_optimizer.load_state_dict(policy_checkpoint['optimizer_state_dict'])
-
-        value_checkpoint = torch.load('SlimeVolley/value.tar')
-        self.value.load_state_dict(value_checkpoint['model_state_dict'])
-        self.value_optimizer.load_state_dict(value_checkpoint['optimizer_state_dict'])
+        self.policy_flat.load_state_dict(torch.load('SlimeVolley/policy.tar', map_location = device))
+        self.value_flat.load_state_dict(torch.load('SlimeVolley/value.tar', map_location = device))
+        self.fused.sync()
 
 class Runner():
     def __init__(self, env, agent, render, training_mode, n_update, n_aux_update, max_action):
@@ -395,7 +883,7 @@ class Runner():
         eps_time = 0
         ############################################ 
         for _ in range(1, 5000):
-            action = self.agent.act(state) 
+            action, action_mean, logprob, value = self.agent.act(state)
 
             action_gym = np.clip(action, -1.0, 1.0) * self.max_action
             next_state, reward, done, _ = self.env.step(action_gym)
@@ -405,7 +893,8 @@ class Runner():
             total_reward += reward
             
             if self.training_mode:
-                self.agent.policy_memory.save_eps(state.tolist(), action.tolist(), reward, float(done), next_state.tolist()) 
+                # Only the first step after env.reset can start a new segment
+                self.agent.save_eps(state, action, action_mean, logprob, value, reward, float(done), next_state, eps_time == 1)
                 
             state = next_state
                     
@@ -482,7 +971,7 @@ def main():
     action_dim          = env.action_space.shape[0]
 
     agent               = Agent(state_dim, action_dim, training_mode, policy_kl_range, policy_params, value_clip, entropy_coef, vf_loss_coef,
-                            batchsize, PPO_epochs, gamma, lam, learning_rate)  
+                            batchsize, PPO_epochs, gamma, lam, learning_rate, n_update, n_aux_update)  
 
     runner              = Runner(env, agent, render, training_mode, n_update, n_aux_update, max_action)
     #############################################     
@@ -0,0 +1,55 @@
+import time
+
+import numpy as np
+import torch
+
+import ppg_dis
+import ppg_dis_pong
+
+def make_agent(module, state_dim, action_dim):
+    return module.Agent(state_dim, action_dim, True, 0.0008, 20, 2.0, 0.05, 1.0, 32, 4, 0.99, 0.95, 2.5e-4, 128, 4)
+
+def original_act(agent, state):
+    # What act did before the inference path: a fresh tensor for every step, both networks with autograd on,
+    # a Categorical to sample from and another one for the log probability
+    device          = agent.policy_flat.data.device
+    state           = torch.FloatTensor(state).unsqueeze(0).to(device)
+    action_probs, _ = agent.policy(state)
+    value           = agent.value(state)
+
+    action  = agent.distributions.sample(action_probs)
+    logprob = agent.distributions.logprob(action_probs, action)
+    return action.cpu().item(), action_probs.squeeze(0).detach().cpu().numpy(), logprob.item(), value.item()
+
+def measure(act, states):
+    act(states[0]) # Warm up
+
+    start = time.perf_counter()
+    for state in states:
+        act(state)
+
+    return (time.perf_counter() - start) / len(states)
+
+def main():
+    ############## Hyperparameters ##############
+    n_step              = 2000 # How many steps are timed
+    #############################################
+    configs = [
+        ('CartPole', ppg_dis, 4, 2),
+        ('Pong', ppg_dis_pong, 80 * 80, 3)
+    ]
+
+    for name, module, state_dim, action_dim in configs:
+        agent   = make_agent(module, state_dim, action_dim)
+
+        # Values of a Pong frame difference, the CartPole networks take them just as well
+        states  = np.random.randint(-1, 2, (n_step, state_dim)).astype(np.float32)
+
+        original_time   = measure(lambda state: original_act(agent, state), states)
+        act_time        = measure(agent.act, states)
+
+        print('{} \t original act: {:.1f} us \t inference act: {:.1f} us \t speedup: {:.2f}x'.format(
+            name, original_time * 1e6, act_time * 1e6, original_time / act_time))
+
+if __name__ == '__main__':
+    main()
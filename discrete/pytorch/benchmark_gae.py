@@ -0,0 +1,81 @@
+import time
+
+import torch
+
+import ppg_dis
+
+device = ppg_dis.device
+
+class LoopPolicyFunction():
+    # The Python loops that PolicyFunction used before the backward scan
+    def __init__(self, gamma = 0.99, lam = 0.95):
+        self.gamma  = gamma
+        self.lam    = lam
+
+    def monte_carlo_discounted(self, rewards, dones):
+        running_add = 0
+        returns     = []
+
+        for step in reversed(range(len(rewards))):
+            running_add = rewards[step] + (1.0 - dones[step]) * self.gamma * running_add
+            returns.insert(0, running_add)
+
+        return torch.stack(returns)
+
+    def generalized_advantage_estimation(self, values, rewards, next_values, dones):
+        gae     = 0
+        adv     = []
+
+        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values
+        for step in reversed(range(len(rewards))):
+            gae = delta[step] + (1.0 - dones[step]) * self.gamma * self.lam * gae
+            adv.insert(0, gae)
+
+        return torch.stack(adv)
+
+def make_rollout(n_steps):
+    values      = torch.randn(n_steps, 1, device = device)
+    next_values = torch.randn(n_steps, 1, device = device)
+    rewards     = torch.randn(n_steps, 1, device = device)
+    dones       = (torch.rand(n_steps, 1, device = device) < 0.01).float()
+
+    return values, rewards, next_values, dones
+
+def measure(fn, n_repeat):
+    result = fn() # Warm up
+
+    start = time.perf_counter()
+    for _ in range(n_repeat):
+        fn()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    return result, (time.perf_counter() - start) / n_repeat
+
+def main():
+    ############## Hyperparameters ##############
+    sizes               = [1000, 10000, 100000] # Rollout lengths that are timed
+    n_repeat            = 3 # How many times each computation is timed
+    gamma               = 0.99
+    lam                 = 0.95
+    #############################################
+    loop_function       = LoopPolicyFunction(gamma, lam)
+    scan_function       = ppg_dis.PolicyFunction(gamma, lam)
+
+    for n_steps in sizes:
+        values, rewards, next_values, dones = make_rollout(n_steps)
+
+        loop_adv, loop_gae_time = measure(lambda: loop_function.generalized_advantage_estimation(values, rewards, next_values, dones), n_repeat)
+        scan_adv, scan_gae_time = measure(lambda: scan_function.generalized_advantage_estimation(values, rewards, next_values, dones), n_repeat)
+
+        loop_ret, loop_mc_time  = measure(lambda: loop_function.monte_carlo_discounted(rewards, dones), n_repeat)
+        scan_ret, scan_mc_time  = measure(lambda: scan_function.monte_carlo_discounted(rewards, dones), n_repeat)
+
+        print('{} steps \t GAE loop: {:.2f} ms \t scan: {:.2f} ms \t speedup: {:.1f}x \t max error: {:.1e}'.format(
+            n_steps, loop_gae_time * 1000, scan_gae_time * 1000, loop_gae_time / scan_gae_time, (loop_adv - scan_adv).abs().max().item()))
+        print('{} steps \t returns loop: {:.2f} ms \t scan: {:.2f} ms \t speedup: {:.1f}x \t max error: {:.1e}'.format(
+            n_steps, loop_mc_time * 1000, scan_mc_time * 1000, loop_mc_time / scan_mc_time, (loop_ret - scan_ret).abs().max().item()))
+
+if __name__ == '__main__':
+    main()
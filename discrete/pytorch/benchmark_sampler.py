@@ -0,0 +1,162 @@
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+import ppg_dis
+import ppg_dis_pong
+
+device = ppg_dis.device
+
+class ListPolicyMemory(Dataset):
+    # The list based memory that update_ppo used to read through a DataLoader
+    def __init__(self):
+        self.actions        = []
+        self.action_probs   = []
+        self.logprobs       = []
+        self.values         = []
+        self.states         = []
+        self.rewards        = []
+        self.dones          = []
+        self.next_states    = []
+        self.advantages     = []
+        self.returns        = []
+
+    def __len__(self):
+        return len(self.dones)
+
+    def __getitem__(self, idx):
+        return np.array(self.states[idx], dtype = np.float32), np.array(self.actions[idx], dtype = np.float32), \
+            np.array(self.action_probs[idx], dtype = np.float32), np.array([self.logprobs[idx]], dtype = np.float32), np.array([self.values[idx]], dtype = np.float32), \
+            np.array(self.advantages[idx], dtype = np.float32), np.array(self.returns[idx], dtype = np.float32)
+
+    def save_eps(self, state, action, action_probs, logprob, value, reward, done, next_state):
+        self.rewards.append(reward)
+        self.states.append(state)
+        self.actions.append(action)
+        self.action_probs.append(action_probs)
+        self.logprobs.append(logprob)
+        self.values.append(value)
+        self.dones.append(done)
+        self.next_states.append(next_state)
+
+    def save_targets(self, advantages, returns):
+        self.advantages = advantages.tolist()
+        self.returns    = returns.tolist()
+
+def make_agent(module, state_dim, action_dim, batchsize, PPO_epochs, n_update):
+    return module.Agent(state_dim, action_dim, True, 0.0008, 20, 2.0, 0.05, 1.0, batchsize, PPO_epochs, 0.99, 0.95, 2.5e-4, n_update, 4)
+
+def fill(agent, list_memory, n_update, state_dim, action_dim):
+    # Values of a Pong frame difference, so the packed Pong memory keeps them exactly
+    next_state = np.random.randint(-1, 2, state_dim).astype(np.float32)
+
+    for _ in range(n_update):
+        state       = next_state
+        next_state  = np.random.randint(-1, 2, state_dim).astype(np.float32)
+        reward      = float(np.random.randn())
+        done        = float(np.random.rand() < 0.05)
+
+        action, action_probs, logprob, value = agent.act(state)
+        agent.save_eps(state, int(action), action_probs, logprob, value, reward, done, next_state)
+        list_memory.save_eps(state.tolist(), int(action), action_probs.tolist(), logprob, value, reward, done, next_state.tolist())
+
+    # Both pipelines serve the same precomputed targets
+    _, _, _, _, values, rewards, dones, next_states = agent.policy_memory.get_all_tensor()
+    advantages, returns = agent.compute_targets(values, rewards, dones, next_states)
+    list_memory.save_targets(advantages, returns)
+
+    return advantages, returns
+
+def run_dataloader(agent, list_memory, PPO_epochs, batchsize, train):
+    dataloader  = DataLoader(list_memory, batchsize, shuffle = False)
+    n_batch     = 0
+
+    for _ in range(PPO_epochs):
+        for batch in dataloader:
+            batch = tuple(datas.float().to(device) for datas in batch)
+
+            if train:
+                agent.training_ppo(*batch)
+            n_batch += 1
+
+    return n_batch
+
+def run_sampler(agent, targets, sampler, PPO_epochs, train):
+    states, actions, action_probs, logprobs, values, _, _, _    = agent.policy_memory.get_all_tensor()
+    advantages, returns                                         = targets
+    n_batch = 0
+
+    # The Pong agent keeps its states packed and expands them per minibatch
+    if hasattr(agent, 'codec'):
+        expand = lambda datas: agent.codec.decode(datas.to(device))
+    else:
+        expand = lambda datas: datas.float().to(device)
+
+    for _ in range(PPO_epochs):
+        for idx in sampler.sample(len(states)):
+            batch = expand(states[idx]), actions[idx].float().to(device), action_probs[idx].to(device), logprobs[idx].to(device), values[idx].to(device), \
+                advantages[idx].to(device), returns[idx].to(device)
+
+            if train:
+                agent.training_ppo(*batch)
+            n_batch += 1
+
+    return n_batch
+
+def run_prefetcher(agent, targets, prefetcher, PPO_epochs, train):
+    datas   = agent.policy_memory.get_all_tensor()[:5] + targets
+    expands = (agent.codec.decode,) + (None,) * 6 if hasattr(agent, 'codec') else None
+    n_batch = 0
+
+    for _ in range(PPO_epochs):
+        for batch in prefetcher.prefetch(datas, expands):
+            if train:
+                agent.training_ppo(*batch)
+            n_batch += 1
+
+    return n_batch
+
+def measure(fn, n_repeat):
+    fn() # Warm up
+
+    start   = time.perf_counter()
+    n_batch = 0
+    for _ in range(n_repeat):
+        n_batch += fn()
+
+    return n_batch / (time.perf_counter() - start)
+
+def main():
+    ############## Hyperparameters ##############
+    n_update            = 1024 # How many transitions are stored before update_ppo
+    batchsize           = 32 # Same as in the trainers
+    PPO_epochs          = 4 # Same as in the trainers
+    n_repeat            = 3 # How many times each update is timed
+    #############################################
+    configs = [
+        ('CartPole', ppg_dis, 4, 2),
+        ('Pong', ppg_dis_pong, 80 * 80, 3)
+    ]
+
+    for name, module, state_dim, action_dim in configs:
+        agent       = make_agent(module, state_dim, action_dim, batchsize, PPO_epochs, n_update)
+        list_memory = ListPolicyMemory()
+        targets     = fill(agent, list_memory, n_update, state_dim, action_dim)
+
+        for train in [False, True]:
+            loader_rate     = measure(lambda: run_dataloader(agent, list_memory, PPO_epochs, batchsize, train), n_repeat)
+            sampler_rate    = measure(lambda: run_sampler(agent, targets, module.MinibatchSampler(batchsize), PPO_epochs, train), n_repeat)
+            shuffle_rate    = measure(lambda: run_sampler(agent, targets, module.MinibatchSampler(batchsize, shuffle = True), PPO_epochs, train), n_repeat)
+
+            prefetcher      = module.MinibatchPrefetcher(module.MinibatchSampler(batchsize), device)
+            prefetch_rate   = measure(lambda: run_prefetcher(agent, targets, prefetcher, PPO_epochs, train), n_repeat)
+
+            print('{} \t {} \t DataLoader: {:.1f} updates/sec \t sampler: {:.1f} updates/sec \t shuffled sampler: {:.1f} updates/sec \t speedup: {:.2f}x'.format(
+                name, 'training' if train else 'data only', loader_rate, sampler_rate, shuffle_rate, sampler_rate / loader_rate))
+            print('{} \t {} \t prefetcher: {:.1f} updates/sec \t overlap: {:.2f}'.format(
+                name, 'training' if train else 'data only', prefetch_rate, prefetcher.overlap))
+
+if __name__ == '__main__':
+    main()
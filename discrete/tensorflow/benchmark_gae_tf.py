@@ -0,0 +1,78 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import ppg_dis_tf
+
+class LoopPolicyFunction(ppg_dis_tf.PolicyFunction):
+    # The Python loop that generalized_advantage_estimation used before the tf.scan, unrolled into one op per step when traced
+    def generalized_advantage_estimation(self, values, rewards, next_values, dones):
+        gae     = 0
+        adv     = []
+
+        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values
+        for step in reversed(range(len(rewards))):
+            gae = delta[step] + (1.0 - dones[step]) * self.gamma * self.lam * gae
+            adv.insert(0, gae)
+
+        return tf.stack(adv)
+
+def make_agent(state_dim, action_dim, batchsize, loop):
+    agent = ppg_dis_tf.Agent(state_dim, action_dim, True, 0.0008, 20, 1.0, 0.05, 1.0, batchsize, 4, 0.99, 0.95, 2.5e-4)
+
+    # The old trainer: the loop GAE traced along with the loss for every new minibatch shape
+    if loop:
+        agent.policy_loss.policy_function   = LoopPolicyFunction(0.99, 0.95)
+        agent.compute_targets               = tf.function(lambda *batch: ppg_dis_tf.Agent.compute_targets(agent, *batch))
+        agent.training_ppo                  = tf.function(lambda *batch: ppg_dis_tf.Agent.training_ppo(agent, *batch))
+
+    return agent
+
+def make_batch(n, state_dim, action_dim):
+    states      = tf.random.normal((n, state_dim))
+    actions     = tf.cast(tf.random.uniform((n,), 0, action_dim, dtype = tf.int32), tf.float32)
+    rewards     = tf.random.normal((n, 1))
+    dones       = tf.cast(tf.random.uniform((n, 1)) < 0.05, tf.float32)
+    next_states = tf.random.normal((n, state_dim))
+
+    return states, actions, rewards, dones, next_states
+
+def update(agent, batch):
+    states, actions, rewards, dones, next_states    = batch
+    advantages, returns                             = agent.compute_targets(states, rewards, dones, next_states)
+
+    agent.training_ppo(states, actions, advantages, returns)
+
+def measure(fn, n_repeat):
+    start = time.perf_counter()
+    for _ in range(n_repeat):
+        fn()
+
+    return (time.perf_counter() - start) / n_repeat
+
+def main():
+    ############## Hyperparameters ##############
+    state_dim           = 4
+    action_dim          = 2
+    batchsizes          = [32, 256, 1024] # Minibatch sizes that are timed
+    partial             = 8 # Size of the last minibatch of a rollout that does not divide evenly
+    n_repeat            = 20 # How many training steps are timed after tracing
+    #############################################
+    for batchsize in batchsizes:
+        full_batch      = make_batch(batchsize, state_dim, action_dim)
+        partial_batch   = make_batch(partial, state_dim, action_dim)
+
+        for loop in [True, False]:
+            agent       = make_agent(state_dim, action_dim, batchsize, loop)
+
+            # The first call of each shape includes its trace
+            trace_time  = measure(lambda: update(agent, full_batch), 1)
+            trace_time  += measure(lambda: update(agent, partial_batch), 1)
+            step_time   = measure(lambda: update(agent, full_batch), n_repeat)
+
+            print('{} \t batch {} \t trace: {:.2f} s \t step: {:.2f} ms \t traces: {} + {}'.format('loop' if loop else 'scan', batchsize, trace_time, step_time * 1000,
+                agent.compute_targets.experimental_get_tracing_count(), agent.training_ppo.experimental_get_tracing_count()))
+
+if __name__ == '__main__':
+    main()
@@ -58,7 +58,7 @@ class PolicyMemory():
         dones = tf.expand_dims(tf.constant(self.dones, dtype = tf.float32), 1)
         next_states = tf.constant(self.next_states, dtype = tf.float32)
         
-        return tf.data.Dataset.from_tensor_slices((states, actions, rewards, dones, next_states))
+        return states, actions, rewards, dones, next_states
 
     def get_all(self):
         return self.states, self.actions, self.rewards, self.dones, self.next_states     
@@ -88,6 +88,10 @@ class AuxMemory():
         states = tf.constant(self.states, dtype = tf.float32)        
         return tf.data.Dataset.from_tensor_slices(states)
 
+    def get_dataset(self, batchsize):
+        # Built once per aux phase and read again by every aux epoch
+        return self.get_all_tensor().batch(batchsize).cache().prefetch(tf.data.experimental.AUTOTUNE)
+
     def save_all(self, states):
         self.states = self.states + states
 
@@ -118,30 +122,25 @@ class PolicyFunction():
         self.gamma  = gamma
         self.lam    = lam
 
+    def backward_scan(self, datas, factors):
+        # Solves y[t] = datas[t] + factors[t] * y[t + 1] in one reverse tf.scan instead of a Python loop over the steps
+        return tf.scan(lambda next_datas, inputs: inputs[0] + inputs[1] * next_datas, (datas, factors),
+            initializer = tf.zeros_like(datas[0]), reverse = True)
+
     def monte_carlo_discounted(self, rewards, dones):
-        running_add = 0
-        returns     = []        
-        
-        for step in reversed(range(len(rewards))):
-            running_add = rewards[step] + (1.0 - dones[step]) * self.gamma * running_add
-            returns.insert(0, running_add)
-            
-        return tf.stack(returns)
+        return self.backward_scan(rewards, (1.0 - dones) * self.gamma)
       
     def temporal_difference(self, reward, next_value, done):
         q_values = reward + (1 - done) * self.gamma * next_value           
         return q_values
       
     def generalized_advantage_estimation(self, values, rewards, next_values, dones):
-        gae     = 0
-        adv     = []     
+        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values
+        return self.backward_scan(delta, (1.0 - dones) * self.gamma * self.lam)
 
-        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values          
-        for step in reversed(range(len(rewards))):
-            gae = delta[step] + (1.0 - dones[step]) * self.gamma * self.lam * gae
-            adv.insert(0, gae)
-            
-        return tf.stack(adv)
+    def lambda_returns(self, values, rewards, next_values, dones):
+        # TD(lambda) targets, the value plus its GAE advantage
+        return self.generalized_advantage_estimation(values, rewards, next_values, dones) + values
 
 class TrulyPPO():
     def __init__(self, policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam):
@@ -154,17 +153,20 @@ class TrulyPPO():
         self.distributions      = Discrete()
         self.policy_function    = PolicyFunction(gamma, lam)
 
+    def compute_targets(self, values, next_values, rewards, dones):
+        # Getting general advantages estimator and returns of the whole rollout
+        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones)
+        Returns         = Advantages + values
+        Advantages      = (Advantages - tf.math.reduce_mean(Advantages)) / (tf.math.reduce_std(Advantages) + 1e-6)
+
+        return Advantages, Returns
+
     # Loss for PPO  
-    def compute_loss(self, action_probs, old_action_probs, values, old_values, next_values, actions, rewards, dones):
+    def compute_loss(self, action_probs, old_action_probs, values, old_values, actions, Advantages, Returns):
         # Don't use old value in backpropagation
         Old_values          = tf.stop_gradient(old_values)
         Old_action_probs    = tf.stop_gradient(old_action_probs)
 
-        # Getting general advantages estimator
-        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones)
-        Returns         = tf.stop_gradient(Advantages + values)
-        Advantages      = tf.stop_gradient((Advantages - tf.math.reduce_mean(Advantages)) / (tf.math.reduce_std(Advantages) + 1e-6))
-
         # Finding the ratio (pi_theta / pi_theta__old):        
         logprobs        = self.distributions.logprob(action_probs, actions)
         Old_logprobs    = tf.stop_gradient(self.distributions.logprob(Old_action_probs, actions))
@@ -237,6 +239,19 @@ class Agent():
         self.optimizer          = tf.keras.optimizers.Adam(learning_rate = learning_rate)
         self.distributions      = Discrete()        
 
+        # The batch dim is left open, so the partial last minibatch runs through the same graph instead of tracing a new one
+        self.training_ppo       = tf.function(self.training_ppo, input_signature = [tf.TensorSpec([None, state_dim], tf.float32), tf.TensorSpec([None], tf.float32),
+            tf.TensorSpec([None, action_dim], tf.float32), tf.TensorSpec([None, action_dim], tf.float32)])
+        self.training_aux       = tf.function(self.training_aux, input_signature = [tf.TensorSpec([None, state_dim], tf.float32)])
+        self.compute_targets    = tf.function(self.compute_targets, input_signature = [tf.TensorSpec([None, state_dim], tf.float32), tf.TensorSpec([None, 1], tf.float32),
+            tf.TensorSpec([None, 1], tf.float32), tf.TensorSpec([None, state_dim], tf.float32)])
+
+        # Built before the first update. Adam makes its slots on the first apply_gradients, which would trace training_ppo twice
+        for model in [self.policy, self.policy_old, self.value, self.value_old]:
+            model(tf.zeros((1, state_dim)))
+
+        self.optimizer.build(self.policy.trainable_variables + self.value.trainable_variables)
+
     def save_eps(self, state, action, reward, done, next_state):
         self.policy_memory.save_eps(state, action, reward, done, next_state)
 
@@ -254,22 +269,26 @@ class Agent():
               
         return action
 
+    def compute_targets(self, states, rewards, dones, next_states):
+        # The GAE needs every step of the episode, so it runs once over the memory before the minibatches are cut
+        values      = self.value(states)
+        next_values = self.value(next_states)
+
+        return self.policy_loss.compute_targets(values, next_values, rewards, dones)
+
     # Get loss and Do backpropagation
-    @tf.function
-    def training_ppo(self, states, actions, rewards, dones, next_states):
+    def training_ppo(self, states, actions, advantages, returns):
         with tf.GradientTape() as tape:
             action_probs, _     = self.policy(states)
             values              = self.value(states)
             old_action_probs, _ = self.policy_old(states)
             old_values          = self.value_old(states)
-            next_values         = self.value(next_states)
 
-            loss                = self.policy_loss.compute_loss(action_probs, old_action_probs, values, old_values, next_values, actions, rewards, dones)
+            loss                = self.policy_loss.compute_loss(action_probs, old_action_probs, values, old_values, actions, advantages, returns)
 
         gradients = tape.gradient(loss, self.policy.trainable_variables + self.value.trainable_variables)        
         self.optimizer.apply_gradients(zip(gradients, self.policy.trainable_variables + self.value.trainable_variables))
 
-    @tf.function
     def training_aux(self, states):
         Returns                             = tf.stop_gradient(self.value(states))
 
@@ -284,9 +303,16 @@ class Agent():
 
     # Update the model
     def update_ppo(self):
+        states, actions, rewards, dones, next_states    = self.policy_memory.get_all_tensor()
+        advantages, returns                             = self.compute_targets(states, rewards, dones, next_states)
+
+        # The targets are sliced along with the steps, every epoch after the first reads the cached batches
+        dataset = tf.data.Dataset.from_tensor_slices((states, actions, advantages, returns))
+        dataset = dataset.batch(self.batchsize).cache().prefetch(tf.data.experimental.AUTOTUNE)
+
         for _ in range(self.PPO_epochs):       
-            for states, actions, rewards, dones, next_states in self.policy_memory.get_all_tensor().batch(self.batchsize):
-                self.training_ppo(states, actions, rewards, dones, next_states)
+            for states, actions, advantages, returns in dataset:
+                self.training_ppo(states, actions, advantages, returns)
 
         # Clear the memory
         states, _, _, _, _ = self.policy_memory.get_all()
@@ -298,9 +324,11 @@ class Agent():
         self.value_old.set_weights(self.value.get_weights())
 
     def update_aux(self):
+        dataset = self.aux_memory.get_dataset(self.batchsize)
+
         # Optimize policy for K epochs:
         for _ in range(self.PPO_epochs): 
-            for states in self.aux_memory.get_all_tensor().batch(self.batchsize):
+            for states in dataset:
                 self.training_aux(states)
 
         # Clear the memory
@@ -0,0 +1,62 @@
+import numpy as np
+import tensorflow as tf
+
+import ppg_dis_tf
+from benchmark_gae_tf import LoopPolicyFunction
+
+def fill_memory(agent, n_steps, state_dim, action_dim, rng):
+    # A rollout that does not divide into the minibatches, so the last one is partial
+    for step in range(n_steps):
+        state       = rng.standard_normal(state_dim).astype(np.float32)
+        next_state  = rng.standard_normal(state_dim).astype(np.float32)
+        action      = float(rng.integers(action_dim))
+        done        = float(rng.random() < 0.05 or step == n_steps - 1)
+
+        agent.save_eps(state.tolist(), action, float(rng.standard_normal()), done, next_state.tolist())
+
+def check_gae(rng):
+    # The reverse tf.scan has to give the advantages of the Python loop it replaced
+    n           = 64
+    values      = tf.constant(rng.standard_normal((n, 1)), dtype = tf.float32)
+    next_values = tf.constant(rng.standard_normal((n, 1)), dtype = tf.float32)
+    rewards     = tf.constant(rng.standard_normal((n, 1)), dtype = tf.float32)
+    dones       = tf.constant((rng.random((n, 1)) < 0.1).astype(np.float32))
+
+    scan_gae    = ppg_dis_tf.PolicyFunction(0.99, 0.95).generalized_advantage_estimation(values, rewards, next_values, dones)
+    loop_gae    = LoopPolicyFunction(0.99, 0.95).generalized_advantage_estimation(values, rewards, next_values, dones)
+
+    np.testing.assert_allclose(scan_gae.numpy(), loop_gae.numpy(), rtol = 1e-5, atol = 1e-5)
+
+def check_update(state_dim, action_dim, batchsize, n_steps, rng):
+    agent = ppg_dis_tf.Agent(state_dim, action_dim, True, 0.0008, 20, 1.0, 0.05, 1.0, batchsize, 4, 0.99, 0.95, 2.5e-4)
+
+    # Two rollouts of different lengths, so both the full and the partial minibatches of each go through the graph
+    for rollout in [n_steps, n_steps + batchsize // 2]:
+        fill_memory(agent, rollout, state_dim, action_dim, rng)
+        agent.update_ppo()
+
+    agent.update_aux()
+
+    assert agent.training_ppo.experimental_get_tracing_count() == 1, 'training_ppo was traced {} times'.format(agent.training_ppo.experimental_get_tracing_count())
+    assert agent.compute_targets.experimental_get_tracing_count() == 1, 'compute_targets was traced {} times'.format(agent.compute_targets.experimental_get_tracing_count())
+    assert agent.training_aux.experimental_get_tracing_count() == 1, 'training_aux was traced {} times'.format(agent.training_aux.experimental_get_tracing_count())
+
+    for weight in agent.policy.get_weights() + agent.value.get_weights():
+        assert np.all(np.isfinite(weight)), 'the update left weights that are not finite'
+
+def main():
+    ############## Hyperparameters ##############
+    state_dim           = 4
+    action_dim          = 2
+    batchsize           = 32
+    n_steps             = 100 # Steps of the first rollout, not a multiple of batchsize
+    #############################################
+    rng = np.random.default_rng(1)
+
+    check_gae(rng)
+    check_update(state_dim, action_dim, batchsize, n_steps, rng)
+
+    print('ok')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import time
+
+import numpy as np
+import torch
+
+import ppg_sync_vect
+import ppg_dist_async_vect
+
+def separate(policy, value, device):
+    # What act ran before: a fresh input tensor, then the policy with its unused critic head and the value network
+    def forward(states):
+        states = torch.FloatTensor(states).to(device)
+        return policy(states)[0], value(states)
+
+    return forward
+
+def measure(fn, states, n_repeat):
+    with torch.no_grad():
+        fn(states) # Warm up
+
+        start = time.perf_counter()
+        for _ in range(n_repeat):
+            fn(states)
+
+    return (time.perf_counter() - start) / n_repeat
+
+def main():
+    ############## Hyperparameters ##############
+    batchsizes          = [1, 8, 64] # How many envs act at once
+    n_repeat            = 1000 # How many forward passes are timed
+    #############################################
+    # The Pong trainers act with the separate networks, it is kept here to show that fusing does not pay off for them.
+    # FusedActorCritic only reads the layers, so the one of ppg_sync_vect also takes the Pong models
+    configs = [
+        ('BipedalWalker', ppg_sync_vect, 24, 4),
+        ('Pong', ppg_dist_async_vect, 80 * 80, 3)
+    ]
+
+    for name, module, state_dim, action_dim in configs:
+        # The rollout workers act on the CPU
+        module.device   = torch.device('cpu')
+        policy          = module.Policy_Model(state_dim, action_dim)
+        value           = module.Value_Model(state_dim, action_dim)
+        fused           = ppg_sync_vect.FusedActorCritic(policy, value, max(batchsizes))
+
+        for batchsize in batchsizes:
+            states          = np.random.randint(-1, 2, (batchsize, state_dim)).astype(np.float32)
+            separate_time   = measure(separate(policy, value, module.device), states, n_repeat)
+            fused_time      = measure(fused, states, n_repeat)
+
+            with torch.no_grad():
+                outputs = zip(separate(policy, value, module.device)(states), fused(states))
+                error   = max((a - b).abs().max().item() for a, b in outputs)
+
+            print('{} \t batch {} \t separate: {:.1f} us \t fused: {:.1f} us \t speedup: {:.2f}x \t max error: {:.1e}'.format(
+                name, batchsize, separate_time * 1e6, fused_time * 1e6, separate_time / fused_time, error))
+
+if __name__ == '__main__':
+    main()
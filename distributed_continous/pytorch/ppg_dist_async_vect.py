@@ -5,7 +5,7 @@ import torch
 import torch.nn as nn
 from torch.distributions import Categorical
 from torch.distributions.kl import kl_divergence
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 from torch.optim import Adam
 from torch.utils.tensorboard import SummaryWriter
 
@@ -13,6 +13,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 import sys
 import numpy
+import threading
+from queue import Queue
+import os
+import tempfile
 import time
 import datetime
 
@@ -58,60 +62,415 @@ class Value_Model(nn.Module):
     def forward(self, states):
         return self.nn_layer(states)
 
+class FlatParameters():
+    # Every parameter of the model is a view into one contiguous buffer, and so are the Adam moments of them.
+    # Copying the weights into another model, to the runners or into a checkpoint is then a single tensor
+    def __init__(self, model, optimizer = None):
+        self.model      = model
+        self.optimizer  = optimizer
+        self.params     = list(model.parameters())
+        self.numels     = [param.numel() for param in self.params]
+
+        self.data       = torch.cat([param.data.reshape(-1) for param in self.params])
+        for param, data in zip(self.params, self.views(self.data)):
+            param.data  = data
+
+        self.steps, self.exp_avg, self.exp_avg_sq = None, None, None
+        if optimizer is not None:
+            # Adam only creates its state on the first step, so views are put there before it does
+            self.steps      = [torch.tensor(0.0) for _ in self.params]
+            self.exp_avg    = torch.zeros_like(self.data)
+            self.exp_avg_sq = torch.zeros_like(self.data)
+
+            for param, step, exp_avg, exp_avg_sq in zip(self.params, self.steps, self.views(self.exp_avg), self.views(self.exp_avg_sq)):
+                optimizer.state[param] = {'step': step, 'exp_avg': exp_avg, 'exp_avg_sq': exp_avg_sq}
+
+    def views(self, datas):
+        return [data.view_as(param) for data, param in zip(datas.split(self.numels), self.params)]
+
+    def copy_(self, data):
+        # An agent.pth from before the flat buffer holds the state dict of the model
+        if isinstance(data, dict):
+            self.model.load_state_dict(data)
+        else:
+            self.data.copy_(data)
+
+    def state_dict(self):
+        if self.steps is None:
+            return {'params': self.data}
+
+        return {'params': self.data, 'steps': torch.stack(self.steps), 'exp_avg': self.exp_avg, 'exp_avg_sq': self.exp_avg_sq}
+
+    def load_state_dict(self, state_dict):
+        if 'model_state_dict' in state_dict:
+            self.load_legacy_state_dict(state_dict)
+            return
+
+        self.data.copy_(state_dict['params'])
+
+        if self.steps is not None and 'steps' in state_dict:
+            for step, saved in zip(self.steps, state_dict['steps']):
+                step.copy_(saved)
+
+            self.exp_avg.copy_(state_dict['exp_avg'])
+            self.exp_avg_sq.copy_(state_dict['exp_avg_sq'])
+
+    def load_legacy_state_dict(self, state_dict):
+        # Checkpoints from before the flat buffers hold the state dicts of the model and of its optimizer.
+        # The model copies into the parameters in place, which are views of data already
+        self.model.load_state_dict(state_dict['model_state_dict'])
+
+        if self.steps is None or 'optimizer_state_dict' not in state_dict:
+            return
+
+        # The optimizer puts new tensors into its state, so they are copied back into the flat buffers
+        # and the state points at the views again
+        self.optimizer.load_state_dict(state_dict['optimizer_state_dict'])
+        for param, step, exp_avg, exp_avg_sq in zip(self.params, self.steps, self.views(self.exp_avg), self.views(self.exp_avg_sq)):
+            saved = self.optimizer.state.get(param, {})
+            if 'exp_avg' in saved:
+                step.fill_(float(saved['step']))
+                exp_avg.copy_(saved['exp_avg'])
+                exp_avg_sq.copy_(saved['exp_avg_sq'])
+
+            self.optimizer.state[param] = {'step': step, 'exp_avg': exp_avg, 'exp_avg_sq': exp_avg_sq}
+
+class FrameCodec():
+    # The frames from prepro only hold -1, 0 or 1, so each state is kept as two bit planes packed into uint8
+    def __init__(self, state_dim):
+        self.state_dim  = state_dim
+        self.packed_dim = 2 * ((state_dim + 7) // 8)
+        self.shifts     = torch.arange(7, -1, -1, dtype = torch.uint8)
+
+    def encode(self, states):
+        states = np.asarray(states)
+        if states.dtype == np.uint8:
+            return states # Already packed by another memory
+
+        return np.concatenate((np.packbits(states > 0, axis = -1), np.packbits(states < 0, axis = -1)), axis = -1)
+
+    def decode(self, states):
+        # Expands a packed minibatch to float32 on the device it already lives on
+        bits    = (states.unsqueeze(-1) >> self.shifts.to(states.device)) & 1
+        bits    = bits.reshape(len(states), 2, -1)[:, :, :self.state_dim].float()
+
+        return bits[:, 0] - bits[:, 1]
+
 class PolicyMemory(Dataset):
-    def __init__(self):
-        self.actions        = [] 
-        self.states         = []
-        self.rewards        = []
-        self.dones          = []     
-        self.next_states    = []
+    # Time-major, row t holds the steps that the n_envs envs took together at time t.
+    # The next state of a step is the state of the same env one row later, so states only has one spare row
+    def __init__(self, state_dim, action_dim, n_envs = 1, capacity = 1024, states = None):
+        self.size           = 0
+        self.n_envs         = n_envs
+        self.codec          = FrameCodec(state_dim)
+
+        self.actions        = np.zeros((capacity, n_envs), dtype = np.int64)
+        self.action_probs   = np.zeros((capacity, n_envs, action_dim), dtype = np.float32) # What act saw, so the packed frames are not decoded again for the old networks
+        self.logprobs       = np.zeros((capacity, n_envs, 1), dtype = np.float32)
+        self.values         = np.zeros((capacity, n_envs, 1), dtype = np.float32)
+        self.states         = states.reshape(capacity + 1, n_envs, -1) if states is not None else np.zeros((capacity + 1, n_envs, self.codec.packed_dim), dtype = np.uint8)
+        self.rewards        = np.zeros((capacity, n_envs, 1), dtype = np.float32)
+        self.dones          = np.zeros((capacity, n_envs, 1), dtype = bool)
 
     def __len__(self):
-        return len(self.dones)
+        return self.size * self.n_envs
 
     def __getitem__(self, idx):
-        return np.array(self.states[idx], dtype = np.float32), np.array(self.actions[idx], dtype = np.float32), \
-            np.array([self.rewards[idx]], dtype = np.float32), np.array([self.dones[idx]], dtype = np.float32), np.array(self.next_states[idx], dtype = np.float32)      
+        step, env = divmod(idx, self.n_envs)
+        return self.states[step, env], self.actions[step, env], self.action_probs[step, env], self.logprobs[step, env], self.values[step, env], \
+            self.rewards[step, env], self.dones[step, env], self.states[step + 1, env]
 
     def get_all(self):
-        return self.states, self.actions, self.rewards, self.dones, self.next_states        
-    
-    def save_all(self, states, actions, rewards, dones, next_states):
-        self.actions = self.actions + actions
-        self.states = self.states + states
-        self.rewards = self.rewards + rewards
-        self.dones = self.dones + dones
-        self.next_states = self.next_states + next_states
-    
-    def save_eps(self, state, action, reward, done, next_state):
-        self.rewards.append(reward)
-        self.states.append(state)
-        self.actions.append(action)
-        self.dones.append(done)
-        self.next_states.append(next_state)
+        # [T, N] views, states has one more row than the steps
+        return self.states[:self.size + 1], self.actions[:self.size], self.action_probs[:self.size], self.logprobs[:self.size], self.values[:self.size], \
+            self.rewards[:self.size], self.dones[:self.size]
+
+    def get_all_tensor(self):
+        # torch.from_numpy shares the buffer, so these are views and not copies
+        return tuple(torch.from_numpy(datas) for datas in self.get_all())
+
+    def save_step(self, states, actions, action_probs, logprobs, values, rewards, dones, next_states):
+        step, _ = self.reserve(1)
+
+        self.actions[step]      = np.reshape(actions, -1)
+        self.action_probs[step] = action_probs
+        self.logprobs[step]     = np.reshape(logprobs, (-1, 1))
+        self.values[step]       = np.reshape(values, (-1, 1))
+        self.states[step]       = self.codec.encode(states)
+        self.states[step + 1]   = self.codec.encode(next_states)
+        self.rewards[step]      = np.reshape(rewards, (-1, 1))
+        self.dones[step]        = np.reshape(dones, (-1, 1))
+
+    def clear_memory(self, states = None):
+        # The aux memory keeps the filled states, so the next rollout is written into the storage it hands back
+        if states is not None:
+            self.states = states.reshape(self.states.shape)
+
+        self.size = 0
+
+    def capacity(self):
+        return len(self.dones)
 
-    def clear_memory(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.rewards[:]
-        del self.dones[:]
-        del self.next_states[:]  
+    def state_rows(self):
+        # Rows of aux storage that states takes up
+        return (self.capacity() + 1) * self.n_envs
+
+    def reserve(self, n):
+        start       = self.size
+        self.size   = start + n
+
+        # Only grows when a rollout is longer than the preallocated capacity
+        if self.size > self.capacity():
+            self.resize(max(self.size, 2 * self.capacity()))
+
+        return start, self.size
+
+    def resize(self, capacity):
+        # states keeps its spare row
+        extra = capacity - self.capacity()
+
+        for name in ['actions', 'action_probs', 'logprobs', 'values', 'states', 'rewards', 'dones']:
+            datas       = getattr(self, name)
+            new_datas   = np.zeros((len(datas) + extra,) + datas.shape[1:], dtype = datas.dtype)
+
+            new_datas[:len(datas)] = datas
+            setattr(self, name, new_datas)
+
+def get_rss():
+    # Resident memory of this process in bytes, or 0 where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
 
 class AuxMemory(Dataset):
-    def __init__(self):
-        self.states = []
+    def __init__(self, state_dim, capacity = 5120, dtype = np.float32, rss_budget = None, spill_dir = None):
+        self.size           = 0
+        self.cursor         = 0
+        self.start          = 0
+        self.contiguous     = True
+
+        self.rss_budget     = rss_budget # In bytes. Past it the storage is moved to a temporary file in spill_dir
+        self.spill_dir      = spill_dir
+        self.spilled_bytes  = 0
+
+        self.storage        = np.zeros((capacity, state_dim), dtype = dtype)
+        self.chunks         = []
+
+        # The storage is not touched yet, so it is counted as if it was already filled
+        if self.rss_budget is not None and get_rss() + self.storage.nbytes > self.rss_budget:
+            self.spill()
 
     def __len__(self):
-        return len(self.states)
+        return self.size
 
     def __getitem__(self, idx):
-        return np.array(self.states[idx], dtype = np.float32)
+        return self.get_all()[idx]
+
+    def next_chunk(self, n):
+        # The policy memory writes its next phase straight into this slice of the storage.
+        # It starts over from the beginning once the aux cycle has been consumed
+        if len(self.chunks) == 0 or self.cursor + n > len(self.storage):
+            self.cursor = 0
+
+        if n <= len(self.storage) and self.is_free(self.cursor, n):
+            return self.storage[self.cursor : self.cursor + n]
+
+        # The storage is still held by chunks of this aux cycle, so the phase gets its own buffer
+        return np.zeros((n, self.storage.shape[1]), dtype = self.storage.dtype)
+
+    def get_all(self):
+        if len(self.chunks) == 1:
+            return self.chunks[0]
+
+        if self.contiguous:
+            return self.storage[self.start : self.start + self.size]
+
+        return np.concatenate(self.chunks)
+
+    def get_all_tensor(self):
+        return torch.from_numpy(self.get_all())
 
     def save_all(self, states):
-        self.states = self.states + states
+        # Only a reference to the chunk is kept, the states are never copied here
+        if len(states) == 0:
+            return
+
+        offset = self.offset(states)
+
+        if len(self.chunks) == 0:
+            self.start      = offset
+            self.contiguous = offset is not None
+        else:
+            self.contiguous = self.contiguous and offset == self.start + self.size
+
+        if offset == self.cursor:
+            self.cursor += len(states)
+
+        if offset is not None and self.on_disk():
+            self.spilled_bytes += states.nbytes
+
+        self.chunks.append(states)
+        self.size += len(states)
 
     def clear_memory(self):
-        del self.states[:]
+        self.size           = 0
+        self.spilled_bytes  = 0 # Counted per aux phase
+        del self.chunks[:]
+
+        # Only checked between aux cycles, when none of the storage is in use
+        if self.rss_budget is not None and not self.on_disk() and get_rss() > self.rss_budget:
+            self.spill()
+
+    def on_disk(self):
+        return isinstance(self.storage, np.memmap)
+
+    def spill(self):
+        # The policy memory then writes its states straight into the file and update_aux reads them back in order
+        self.file       = tempfile.TemporaryFile(dir = self.spill_dir)
+        self.storage    = np.memmap(self.file, dtype = self.storage.dtype, mode = 'w+', shape = self.storage.shape)
+
+        print('Aux memory is over the RSS budget, its states are kept on disk from now on')
+
+    def is_free(self, start, n):
+        for chunk in self.chunks:
+            offset = self.offset(chunk)
+            if offset is not None and start < offset + len(chunk) and offset < start + n:
+                return False
+
+        return True
+
+    def offset(self, states):
+        # Row of the storage where states begins, or None if states was not handed out by next_chunk
+        if len(states) == 0 or not np.may_share_memory(states, self.storage):
+            return None
+
+        return (states.ctypes.data - self.storage.ctypes.data) // self.storage.strides[0]
+
+class MinibatchSampler():
+    def __init__(self, batchsize, shuffle = False):
+        self.batchsize  = batchsize
+        self.shuffle    = shuffle
+
+    def sample(self, n):
+        # Yields slices, or chunks of one index permutation when shuffling,
+        # so each minibatch is gathered from the whole tensors in a single indexing op
+        if self.shuffle:
+            indices = torch.randperm(n)
+            for start in range(0, n, self.batchsize):
+                yield indices[start : start + self.batchsize]
+
+        else:
+            for start in range(0, n, self.batchsize):
+                yield slice(start, start + self.batchsize)
+
+class MinibatchPrefetcher():
+    def __init__(self, sampler, device, depth = 2):
+        self.sampler    = sampler
+        self.device     = device
+        self.depth      = depth # How many minibatches are assembled ahead of the training step
+
+        self.pinned     = device.type == 'cuda'
+        self.stream     = torch.cuda.Stream(device) if self.pinned else None
+        self.consumer   = None
+        self.key        = None
+        self.slots      = []
+
+        self.fetch_time = 0.0
+        self.wait_time  = 0.0
+        self.overlap    = 0.0 # Share of the time spent assembling minibatches that was hidden behind training
+
+    def prefetch(self, datas, expands = None):
+        # Yields the minibatches of datas on the device while a background thread gathers, converts and copies the next ones.
+        # A field with an expand function keeps its own dtype and is expanded after the copy, the others become float32
+        expands = expands if expands is not None else (None,) * len(datas)
+        self.allocate(datas, expands)
+
+        queue           = Queue(self.depth)
+        self.consumer   = torch.cuda.current_stream(self.device) if self.pinned else None
+        self.fetch_time = 0.0
+        self.wait_time  = 0.0
+
+        thread = threading.Thread(target = self.produce, args = (queue, datas, expands), daemon = True)
+        thread.start()
+
+        while True:
+            start           = time.perf_counter()
+            batch           = queue.get()
+            self.wait_time  += time.perf_counter() - start
+
+            if batch is None:
+                break
+
+            if isinstance(batch, Exception):
+                raise batch
+
+            batch, event = batch
+            if event is not None:
+                self.consumer.wait_event(event)
+
+            yield batch
+
+        thread.join()
+        self.overlap = 1.0 - min(self.wait_time / self.fetch_time, 1.0) if self.fetch_time > 0 else 0.0
+
+    def produce(self, queue, datas, expands):
+        try:
+            for i, idx in enumerate(self.sampler.sample(len(datas[0]))):
+                start           = time.perf_counter()
+                batch           = self.fetch(self.slots[i % len(self.slots)], datas, expands, idx)
+                self.fetch_time += time.perf_counter() - start
+
+                queue.put(batch)
+
+            queue.put(None)
+
+        except Exception as e:
+            queue.put(e)
+
+    def fetch(self, slot, datas, expands, idx):
+        buffers, event = slot
+
+        # The staging buffers of a slot are reused only after the copies out of them are done
+        if event is not None:
+            event.synchronize()
+
+        staged = []
+        for buffer, data in zip(buffers, datas):
+            rows = data[idx]
+            staged.append(buffer[:len(rows)].copy_(rows))
+
+        if self.stream is None:
+            staged = [datas.to(self.device) for datas in staged]
+            return tuple(expand(datas) if expand is not None else datas for datas, expand in zip(staged, expands)), None
+
+        with torch.cuda.stream(self.stream):
+            batch = []
+            for datas, expand in zip(staged, expands):
+                datas = datas.to(self.device, non_blocking = True)
+                datas = expand(datas) if expand is not None else datas
+
+                datas.record_stream(self.consumer)
+                batch.append(datas)
+
+            event.record(self.stream)
+
+        return tuple(batch), event
+
+    def allocate(self, datas, expands):
+        # One set of staging buffers for each minibatch that can be in flight: queued, being trained on and being filled
+        samples = [data[0:1] for data in datas]
+        key     = tuple((sample.shape[1:], sample.dtype if expand is not None else torch.float32) for sample, expand in zip(samples, expands))
+
+        if key == self.key:
+            return
+
+        self.key    = key
+        self.slots  = []
+        for _ in range(self.depth + 2):
+            buffers = tuple(torch.empty((self.sampler.batchsize,) + shape, dtype = dtype, pin_memory = self.pinned) for shape, dtype in key)
+            self.slots.append((buffers, torch.cuda.Event() if self.pinned else None))
 
 class Discrete():
     def sample(self, datas):
@@ -132,35 +491,73 @@ class Discrete():
 
         return kl_divergence(distribution1, distribution2).unsqueeze(1).float().to(device)  
 
+class DiscreteSampler():
+    # Draws the actions of act straight from the probabilities, without a Categorical on every step.
+    # The uniform numbers go into a buffer that is kept between steps, and the action is the first one
+    # whose cumulative probability passes its number
+    def __init__(self, myDevice = None, capacity = 1):
+        self.device = myDevice if myDevice != None else device
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        # Made outside of inference mode, so the buffer can be written in or out of it
+        with torch.inference_mode(False):
+            self.capacity   = capacity
+            self.noise      = torch.zeros((capacity, 1), device = self.device)
+
+    def sample(self, action_probs, training_mode = True):
+        n = len(action_probs)
+        if n > self.capacity:
+            self.allocate(n)
+
+        if training_mode:
+            cdf     = action_probs.cumsum(1)
+            noise   = self.noise[:n].uniform_().mul_(cdf[:, -1:])
+            actions = (cdf < noise).sum(1).clamp_(max = action_probs.shape[1] - 1)
+        else:
+            actions = action_probs.argmax(1)
+
+        # Clamped like Categorical clamps the probabilities, so these are the log probabilities the update computes
+        eps         = torch.finfo(action_probs.dtype).eps
+        logprobs    = action_probs.gather(1, actions.unsqueeze(1)).clamp_(eps, 1 - eps).log_()
+        return actions, logprobs
+
 class PolicyFunction():
     def __init__(self, gamma = 0.99, lam = 0.95):
         self.gamma  = gamma
         self.lam    = lam
 
+    def backward_scan(self, datas, factors):
+        # Solves y[t] = datas[t] + factors[t] * y[t + 1] for every step at once.
+        # Each pass folds in the steps twice as far ahead, so a rollout takes log2(n) passes instead of n
+        shift = 1
+        while shift < len(datas):
+            datas   = torch.cat([datas[:-shift] + factors[:-shift] * datas[shift:], datas[-shift:]])
+            factors = torch.cat([factors[:-shift] * factors[shift:], factors[-shift:]])
+            shift   *= 2
+
+        return datas
+
     def monte_carlo_discounted(self, rewards, dones):
-        running_add = 0
-        returns     = []        
-        
-        for step in reversed(range(len(rewards))):
-            running_add = rewards[step] + (1.0 - dones[step]) * self.gamma * running_add
-            returns.insert(0, running_add)
-            
-        return torch.stack(returns)
+        return self.backward_scan(rewards, (1.0 - dones) * self.gamma)
       
     def temporal_difference(self, reward, next_value, done):
         q_values = reward + (1 - done) * self.gamma * next_value           
         return q_values
       
-    def generalized_advantage_estimation(self, values, rewards, next_values, dones):
-        gae     = 0
-        adv     = []     
-
-        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values          
-        for step in reversed(range(len(rewards))):
-            gae = delta[step] + (1.0 - dones[step]) * self.gamma * self.lam * gae
-            adv.insert(0, gae)
-            
-        return torch.stack(adv)
+    def generalized_advantage_estimation(self, values, rewards, next_values, dones, ends = None):
+        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values
+        factors = (1.0 - dones) * self.gamma * self.lam
+
+        # A step whose next state is not in the following row ends its segment, so its advantage does not run on into that row
+        if ends is not None:
+            factors = factors.masked_fill(ends, 0.0)
+
+        return self.backward_scan(delta, factors)
+
+    def lambda_returns(self, values, rewards, next_values, dones):
+        # TD(lambda) targets, the value plus its GAE advantage
+        return self.generalized_advantage_estimation(values, rewards, next_values, dones) + values
 
 class TrulyPPO():
     def __init__(self, policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam):
@@ -173,20 +570,23 @@ class TrulyPPO():
         self.distributions      = Discrete()
         self.policy_function    = PolicyFunction(gamma, lam)
 
+    def compute_targets(self, values, next_values, rewards, dones, ends = None):
+        # Getting general advantages estimator and returns of the whole rollout
+        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones, ends)
+        Returns         = Advantages + values
+        Advantages      = (Advantages - Advantages.mean()) / (Advantages.std() + 1e-6)
+
+        return Advantages, Returns
+
     # Loss for PPO  
-    def compute_loss(self, action_probs, old_action_probs, values, old_values, next_values, actions, rewards, dones):
+    def compute_loss(self, action_probs, old_action_probs, old_logprobs, values, old_values, actions, Advantages, Returns):
         # Don't use old value in backpropagation
         Old_values          = old_values.detach()
         Old_action_probs    = old_action_probs.detach()     
 
-        # Getting general advantages estimator and returns
-        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones)
-        Returns         = (Advantages + values).detach()
-        Advantages      = ((Advantages - Advantages.mean()) / (Advantages.std() + 1e-6)).detach()
-
         # Finding the ratio (pi_theta / pi_theta__old): 
         logprobs        = self.distributions.logprob(action_probs, actions)
-        Old_logprobs    = self.distributions.logprob(Old_action_probs, actions).detach()
+        Old_logprobs    = old_logprobs.detach()
 
         # Finding Surrogate Loss
         ratios          = (logprobs - Old_logprobs).exp() # ratios = old_logprobs / logprobs        
@@ -232,7 +632,7 @@ class JointAux():
 
 class Agent():  
     def __init__(self, state_dim, action_dim, is_training_mode, policy_kl_range, policy_params, value_clip, entropy_coef, vf_loss_coef,
-                 batchsize, PPO_epochs, gamma, lam, learning_rate):        
+                 batchsize, PPO_epochs, gamma, lam, learning_rate, n_update, n_aux_update, n_envs = 1, rss_budget = None):        
         self.policy_kl_range    = policy_kl_range 
         self.policy_params      = policy_params
         self.value_clip         = value_clip    
@@ -241,23 +641,30 @@ class Agent():
         self.batchsize          = batchsize
         self.PPO_epochs         = PPO_epochs
         self.is_training_mode   = is_training_mode
+        self.state_dim          = state_dim
         self.action_dim         = action_dim     
 
         self.policy             = Policy_Model(state_dim, action_dim)
-        self.policy_old         = Policy_Model(state_dim, action_dim)
         self.policy_optimizer   = Adam(self.policy.parameters(), lr = learning_rate)
+        self.policy_flat        = FlatParameters(self.policy, self.policy_optimizer)
 
         self.value              = Value_Model(state_dim, action_dim)
-        self.value_old          = Value_Model(state_dim, action_dim)
         self.value_optimizer    = Adam(self.value.parameters(), lr = learning_rate)
+        self.value_flat         = FlatParameters(self.value, self.value_optimizer)
 
-        self.policy_memory      = PolicyMemory()
-        self.policy_loss        = TrulyPPO(policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam)
+        rollout_size            = n_update * n_envs
 
-        self.aux_memory         = AuxMemory()
+        self.codec              = FrameCodec(state_dim)
+        self.aux_memory         = AuxMemory(self.codec.packed_dim, rollout_size * n_aux_update + n_envs, np.uint8, rss_budget)
         self.aux_loss           = JointAux()
+        self.sampler            = MinibatchSampler(batchsize)
+        self.prefetcher         = MinibatchPrefetcher(self.sampler, device)
+
+        self.policy_memory      = PolicyMemory(state_dim, action_dim, n_envs, n_update, self.aux_memory.next_chunk((n_update + 1) * n_envs))
+        self.policy_loss        = TrulyPPO(policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam)
          
         self.distributions      = Discrete()        
+        self.action_sampler     = DiscreteSampler()
 
         if is_training_mode:
           self.policy.train()
@@ -266,35 +673,55 @@ class Agent():
           self.policy.eval()
           self.value.eval()
 
-    def save_eps(self, state, action, reward, done, next_state):
-        self.policy_memory.save_eps(state, action, reward, done, next_state)
-
-    def save_all(self, states, actions, rewards, dones, next_states):
-        self.policy_memory.save_all(states, actions, rewards, dones, next_states)
+    def save_step(self, states, actions, action_probs, logprobs, values, rewards, dones, next_states):
+        self.policy_memory.save_step(states, actions, action_probs, logprobs, values, rewards, dones, next_states)
 
     def act(self, state):
-        state           = torch.FloatTensor(state).to(device).detach()
-        action_probs, _ = self.policy(state)
-
-        # We don't need sample the action in Test Mode
-        # only sampling the action in Training Mode in order to exploring the actions
-        if self.is_training_mode:
-            # Sample the action
-            action  = self.distributions.sample(action_probs) 
-        else:
-            action  = torch.argmax(action_probs, 1)  
-              
-        return action.cpu().numpy()
+        # Fusing the networks did not speed up Pong, the 6400 wide input layers cost the same either way
+        state = torch.as_tensor(np.asarray(state, dtype = np.float32)).reshape(-1, self.state_dim).to(device)
+
+        with torch.inference_mode():
+            action_probs, _      = self.policy(state)
+            values               = self.value(state)
+
+            # We don't need sample the action in Test Mode
+            # only sampling the action in Training Mode in order to exploring the actions
+            action, logprobs     = self.action_sampler.sample(action_probs, self.is_training_mode)
+
+        # The frames are still unpacked here, and the networks do not change until the rollout is full
+        return action.cpu().numpy(), action_probs.cpu().numpy(), logprobs.cpu().numpy(), values.cpu().numpy()
+
+    def compute_targets(self, states, values, rewards, dones):
+        # The values of the steps were recorded when acting, so only the row of states after the last step is valued here.
+        # The scan runs along the time axis for all envs at once
+        with torch.no_grad():
+            last_values = self.value(self.codec.decode(states[-1].to(device))).cpu()
+
+        next_values         = torch.cat([values[1:], last_values.unsqueeze(0)])
+        advantages, returns = self.policy_loss.compute_targets(values.to(device), next_values.to(device), rewards.to(device), dones.float().to(device))
+
+        # The prefetcher gathers the minibatches on the host
+        return advantages.flatten(0, 1).cpu(), returns.flatten(0, 1).cpu()
+
+    def compute_aux_targets(self, states):
+        # The aux phase only trains the policy, and the old policy is the one it starts from.
+        # Each frame is decoded and run through both networks once for the whole phase
+        returns, old_action_probs = [], []
+
+        with torch.no_grad():
+            for start in range(0, len(states), self.batchsize):
+                batch = self.codec.decode(states[start : start + self.batchsize].to(device))
+                returns.append(self.value(batch).cpu())
+                old_action_probs.append(self.policy(batch)[0].cpu())
+
+        return torch.cat(returns), torch.cat(old_action_probs)
 
     # Get loss and Do backpropagation
-    def training_ppo(self, states, actions, rewards, dones, next_states):
+    def training_ppo(self, states, actions, old_action_probs, old_logprobs, old_values, advantages, returns):
         action_probs, _     = self.policy(states)
         values              = self.value(states)
-        old_action_probs, _ = self.policy_old(states)
-        old_values          = self.value_old(states)
-        next_values         = self.value(next_states)
 
-        loss                = self.policy_loss.compute_loss(action_probs, old_action_probs, values, old_values, next_values, actions, rewards, dones)
+        loss                = self.policy_loss.compute_loss(action_probs, old_action_probs, old_logprobs, values, old_values, actions, advantages, returns)
 
         self.policy_optimizer.zero_grad()
         self.value_optimizer.zero_grad()
@@ -304,11 +731,8 @@ class Agent():
         self.policy_optimizer.step()
         self.value_optimizer.step()
 
-    def training_aux(self, states):
-        Returns                         = self.value(states).detach()
-
+    def training_aux(self, states, Returns, old_action_probs):
         action_probs, values            = self.policy(states)
-        old_action_probs, _             = self.policy_old(states)
 
         joint_loss                      = self.aux_loss.compute_loss(action_probs, old_action_probs, values, Returns)
 
@@ -318,56 +742,49 @@ class Agent():
 
     # Update the model
     def update_ppo(self):
-        dataloader  = DataLoader(self.policy_memory, self.batchsize, shuffle = False)
+        states, actions, action_probs, logprobs, values, rewards, dones = self.policy_memory.get_all_tensor()
+        advantages, returns = self.compute_targets(states, values, rewards, dones)
+
+        # The envs are only flattened for the minibatches, these are views of the same buffers
+        datas = (states[:-1].flatten(0, 1), actions.flatten(0, 1), action_probs.flatten(0, 1), logprobs.flatten(0, 1), values.flatten(0, 1), advantages, returns)
 
         # Optimize policy for K epochs:        
         for _ in range(self.PPO_epochs):
-            for states, actions, rewards, dones, next_states in dataloader:
-                self.training_ppo(states.float().to(device), actions.float().to(device), \
-                    rewards.float().to(device), dones.float().to(device), next_states.float().to(device))
+            for batch in self.prefetcher.prefetch(datas, (self.codec.decode, None, None, None, None, None, None)):
+                self.training_ppo(*batch)
 
         # Clear the memory
-        states, _, _, _, _ = self.policy_memory.get_all()
-        self.aux_memory.save_all(states)
-        self.policy_memory.clear_memory()
-
-        # Copy new weights into old policy:
-        self.policy_old.load_state_dict(self.policy.state_dict())
-        self.value_old.load_state_dict(self.value.state_dict())
+        states = self.policy_memory.get_all()[0]
+        self.aux_memory.save_all(states[:-1].reshape(-1, states.shape[-1]))
+        self.policy_memory.clear_memory(self.aux_memory.next_chunk(self.policy_memory.state_rows()))
 
     def update_aux(self):
-        dataloader  = DataLoader(self.aux_memory, self.batchsize, shuffle = False)
+        states                      = self.aux_memory.get_all_tensor()
+        returns, old_action_probs   = self.compute_aux_targets(states)
 
         # Optimize policy for K epochs:
         for _ in range(self.PPO_epochs): 
-            for states in dataloader:
-                self.training_aux(states.float().to(device))
+            for batch in self.prefetcher.prefetch((states, returns, old_action_probs), (self.codec.decode, None, None)):
+                self.training_aux(*batch)
+
+        if self.aux_memory.on_disk():
+            print('Aux states spilled to disk: {:.1f} MB'.format(self.aux_memory.spilled_bytes / 2 ** 20))
 
         # Clear the memory
         self.aux_memory.clear_memory()
 
-        # Copy new weights into old policy:
-        self.policy_old.load_state_dict(self.policy.state_dict())
+        # The whole storage is free again, so the next rollout can be written into it
+        if len(self.policy_memory) == 0:
+            self.policy_memory.clear_memory(self.aux_memory.next_chunk(self.policy_memory.state_rows()))
 
     def save_weights(self):
-        torch.save({
-            'model_state_dict': self.policy.state_dict(),
-            'optimizer_state_dict': self.policy_optimizer.state_dict()
-            }, 'Pong/policy.tar')
+        torch.save(self.policy_flat.state_dict(), 'Pong/policy.tar')
         
-        torch.save({
-            'model_state_dict': self.value.state_dict(),
-            'optimizer_state_dict': self.value_optimizer.state_dict()
-            }, 'Pong/value.tar')
+        torch.save(self.value_flat.state_dict(), 'Pong/value.tar')
         
     def load_weights(self):
-        policy_checkpoint = torch.load('Pong/policy.tar')
-        self.policy.load_state_dict(policy_checkpoint['model_state_dict'])
-        self.policy_optimizer.load_state_dict(policy_checkpoint['optimizer_state_dict'])
-
-        value_checkpoint = torch.load('Pong/value.tar')
-        self.value.load_state_dict(value_checkpoint['model_state_dict'])
-        self.value_optimizer.load_state_dict(value_checkpoint['optimizer_state_dict'])
+        self.policy_flat.load_state_dict(torch.load('Pong/policy.tar', map_location = device))
+        self.value_flat.load_state_dict(torch.load('Pong/value.tar', map_location = device))
 
 def prepro(I):
     I           = I[35:195] # crop
@@ -416,7 +833,6 @@ class VectorEnv:
 class Runner():
     def __init__(self, envs, agent, render, training_mode, n_update, n_aux_update, max_action):
         self.envs       = VectorEnv(envs)
-        self.memories   = [PolicyMemory() for _ in range(len(envs))]
 
         self.agent          = agent
         self.render         = render
@@ -439,25 +855,27 @@ class Runner():
         eps_time        = 0
         ############################################ 
         for _ in range(self.n_update * self.n_aux_update):
-            actions     = self.agent.act(states)
+            actions, action_probs, logprobs, values = self.agent.act(states)
             actions_gym = [int(action) + 1 if action != 0 else 0 for action in actions] 
 
             datas       = self.envs.step(actions_gym)
 
             rewards     = []
+            dones       = []
             next_states = []
             next_obs    = []
-            for state, action, memory, data, ob in zip(states, actions, self.memories, datas, obs):
+            for data, ob in zip(datas, obs):
                 next_ob, reward, done, _    = data
                 next_ob                     = prepro(next_ob)
                 next_state                  = next_ob - ob
 
                 rewards.append(reward)
+                dones.append(done)
                 next_states.append(next_state)
                 next_obs.append(next_ob)
                 
-                if self.training_mode:
-                    memory.save_eps(state.tolist(), action.tolist(), reward, float(done), next_state.tolist())
+            if self.training_mode:
+                self.agent.save_step(states, actions, action_probs, logprobs, values, rewards, dones, next_states)
             
             eps_time += 1 
             self.t_updates += 1
@@ -470,11 +888,6 @@ class Runner():
                 self.envs.render()
             
             if self.training_mode and self.n_update is not None and self.t_updates == self.n_update:
-                for memory in self.memories:
-                    temp_states, temp_actions, temp_rewards, temp_dones, temp_next_states = memory.get_all()
-                    self.agent.save_all(temp_states, temp_actions, temp_rewards, temp_dones, temp_next_states)
-                    memory.clear_memory()
-
                 self.agent.update_ppo()
                 self.t_updates = 0
                 self.t_aux_updates += 1
@@ -520,6 +933,7 @@ def main():
     batchsize           = 32 # How many batch per update. size of batch = n_update / batchsize. Rocommended set to 4 for Discrete
     PPO_epochs          = 4 # How many epoch per update
     n_aux_update        = 5
+    rss_budget          = None # In bytes. Once the process uses more memory than this the aux states are kept in a temporary file. None keeps them in RAM
     max_action          = 1.0
     
     gamma               = 0.99 # Just set to 0.99
@@ -535,7 +949,7 @@ def main():
     action_dim          = 3 #env[0].action_space.shape[0]
 
     agent               = Agent(state_dim, action_dim, training_mode, policy_kl_range, policy_params, value_clip, entropy_coef, vf_loss_coef,
-                            batchsize, PPO_epochs, gamma, lam, learning_rate)  
+                            batchsize, PPO_epochs, gamma, lam, learning_rate, n_update, n_aux_update, len(env), rss_budget)  
 
     runner              = Runner(env, agent, render, training_mode, n_update, n_aux_update, max_action)
     #############################################     
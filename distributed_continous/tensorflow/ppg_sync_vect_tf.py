@@ -43,48 +43,43 @@ class Value_Model(Model):
         return self.critic(x)
 
 class PolicyMemory():
+    # Time-major, each entry holds the steps that all envs took together at one time step.
+    # The next states of a step are the states of the entry after it, so only the ones after the final step are kept apart
     def __init__(self):
         self.actions        = [] 
         self.states         = []
         self.rewards        = []
         self.dones          = []     
-        self.next_states    = []
+        self.last_states    = None
 
     def __len__(self):
         return len(self.dones)
 
     def get_all_tensor(self):
-        states      = tf.constant(self.states, dtype = tf.float32)
-        actions     = tf.constant(self.actions, dtype = tf.float32)
-        rewards     = tf.expand_dims(tf.constant(self.rewards, dtype = tf.float32), 1)
-        dones       = tf.expand_dims(tf.constant(self.dones, dtype = tf.float32), 1)
-        next_states = tf.constant(self.next_states, dtype = tf.float32)
+        # states is [T + 1, N], the others are [T, N]
+        states      = tf.constant(np.array(self.states + [self.last_states]), dtype = tf.float32)
+        actions     = tf.constant(np.array(self.actions), dtype = tf.float32)
+        rewards     = tf.expand_dims(tf.constant(np.array(self.rewards), dtype = tf.float32), 2)
+        dones       = tf.expand_dims(tf.constant(np.array(self.dones), dtype = tf.float32), 2)
         
-        return tf.data.Dataset.from_tensor_slices((states, actions, rewards, dones, next_states))
+        return states, actions, rewards, dones
 
     def get_all(self):
-        return self.states, self.actions, self.rewards, self.dones, self.next_states     
-
-    def save_eps(self, state, action, reward, done, next_state):
-        self.rewards.append(reward)
-        self.states.append(state)
-        self.actions.append(action)
-        self.dones.append(done)
-        self.next_states.append(next_state)  
-
-    def save_all(self, states, actions, rewards, dones, next_states):
-        self.actions      += actions
-        self.states       += states
-        self.rewards      += rewards
-        self.dones        += dones
-        self.next_states  += next_states      
+        return self.states, self.actions, self.rewards, self.dones, self.last_states
+
+    def save_step(self, states, actions, rewards, dones, next_states):
+        self.rewards.append(rewards)
+        self.states.append(states)
+        self.actions.append(actions)
+        self.dones.append(dones)
+        self.last_states = next_states
 
     def clear_memory(self):
         del self.actions[:]
         del self.states[:]
         del self.rewards[:]
         del self.dones[:]
-        del self.next_states[:]
+        self.last_states = None
 
 class AuxMemory():
     def __init__(self):
@@ -97,6 +92,10 @@ class AuxMemory():
         states = tf.constant(self.states, dtype = tf.float32)        
         return tf.data.Dataset.from_tensor_slices(states)
 
+    def get_dataset(self, batchsize):
+        # Built once per aux phase and read again by every aux epoch
+        return self.get_all_tensor().batch(batchsize).cache().prefetch(tf.data.experimental.AUTOTUNE)
+
     def save_all(self, states):
         self.states = self.states + states
 
@@ -127,30 +126,25 @@ class PolicyFunction():
         self.gamma  = gamma
         self.lam    = lam
 
+    def backward_scan(self, datas, factors):
+        # Solves y[t] = datas[t] + factors[t] * y[t + 1] in one reverse tf.scan instead of a Python loop over the steps
+        return tf.scan(lambda next_datas, inputs: inputs[0] + inputs[1] * next_datas, (datas, factors),
+            initializer = tf.zeros_like(datas[0]), reverse = True)
+
     def monte_carlo_discounted(self, rewards, dones):
-        running_add = 0
-        returns     = []        
-        
-        for step in reversed(range(len(rewards))):
-            running_add = rewards[step] + (1.0 - dones[step]) * self.gamma * running_add
-            returns.insert(0, running_add)
-            
-        return tf.stack(returns)
+        return self.backward_scan(rewards, (1.0 - dones) * self.gamma)
       
     def temporal_difference(self, reward, next_value, done):
         q_values = reward + (1 - done) * self.gamma * next_value           
         return q_values
       
     def generalized_advantage_estimation(self, values, rewards, next_values, dones):
-        gae     = 0
-        adv     = []     
+        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values
+        return self.backward_scan(delta, (1.0 - dones) * self.gamma * self.lam)
 
-        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values          
-        for step in reversed(range(len(rewards))):
-            gae = delta[step] + (1.0 - dones[step]) * self.gamma * self.lam * gae
-            adv.insert(0, gae)
-            
-        return tf.stack(adv)
+    def lambda_returns(self, values, rewards, next_values, dones):
+        # TD(lambda) targets, the value plus its GAE advantage
+        return self.generalized_advantage_estimation(values, rewards, next_values, dones) + values
 
 class TrulyPPO():
     def __init__(self, policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam):
@@ -163,17 +157,20 @@ class TrulyPPO():
         self.distributions      = Continous()
         self.policy_function    = PolicyFunction(gamma, lam)
 
+    def compute_targets(self, values, next_values, rewards, dones):
+        # Getting general advantages estimator and returns of the whole rollout
+        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones)
+        Returns         = Advantages + values
+        Advantages      = (Advantages - tf.math.reduce_mean(Advantages)) / (tf.math.reduce_std(Advantages) + 1e-6)
+
+        return Advantages, Returns
+
     # Loss for PPO  
-    def compute_loss(self, action_mean, action_std, old_action_mean, old_action_std, values, old_values, next_values, actions, rewards, dones):
+    def compute_loss(self, action_mean, action_std, old_action_mean, old_action_std, values, old_values, actions, Advantages, Returns):
         # Don't use old value in backpropagation
         Old_values         = tf.stop_gradient(old_values)
         Old_action_mean    = tf.stop_gradient(old_action_mean)
 
-        # Getting general advantages estimator
-        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones)
-        Returns         = tf.stop_gradient(Advantages + values)
-        Advantages      = tf.stop_gradient((Advantages - tf.math.reduce_mean(Advantages)) / (tf.math.reduce_std(Advantages) + 1e-6))
-
         # Finding the ratio (pi_theta / pi_theta__old):        
         logprobs        = self.distributions.logprob(action_mean, action_std, actions)
         Old_logprobs    = tf.stop_gradient(self.distributions.logprob(Old_action_mean, old_action_std, actions))
@@ -247,11 +244,21 @@ class Agent():
         self.optimizer          = tf.keras.optimizers.Adam(learning_rate = learning_rate)
         self.distributions      = Continous()        
 
-    def save_eps(self, state, action, reward, done, next_state):
-        self.policy_memory.save_eps(state, action, reward, done, next_state)
+        # The flattened rollout rarely divides into full minibatches, an open batch dim keeps it to a single trace
+        self.training_ppo       = tf.function(self.training_ppo, input_signature = [tf.TensorSpec([None, state_dim], tf.float32), tf.TensorSpec([None, action_dim], tf.float32),
+            tf.TensorSpec([None, action_dim], tf.float32), tf.TensorSpec([None, action_dim], tf.float32)])
+        self.training_aux       = tf.function(self.training_aux, input_signature = [tf.TensorSpec([None, state_dim], tf.float32)])
+        self.compute_targets    = tf.function(self.compute_targets, input_signature = [tf.TensorSpec([None, None, state_dim], tf.float32), tf.TensorSpec([None, None, 1], tf.float32),
+            tf.TensorSpec([None, None, 1], tf.float32)])
+
+        # Creating variables inside a tf.function traces it again, so the models and the optimizer are built before the first step
+        for model in [self.policy, self.policy_old, self.value, self.value_old]:
+            model(tf.zeros((1, state_dim)))
+
+        self.optimizer.build(self.policy.trainable_variables + self.value.trainable_variables)
 
-    def save_all(self, states, actions, rewards, dones, next_states):
-        self.policy_memory.save_all(states, actions, rewards, dones, next_states)
+    def save_step(self, states, actions, rewards, dones, next_states):
+        self.policy_memory.save_step(states, actions, rewards, dones, next_states)
 
     def act(self, state):
         state           = tf.expand_dims(tf.cast(state, dtype = tf.float32), 0)
@@ -267,22 +274,27 @@ class Agent():
               
         return tf.squeeze(action)
 
+    def compute_targets(self, states, rewards, dones):
+        # The values are computed once per rollout, states has one more row than the steps
+        # so the next values are the values one row later. The scan runs along the time axis for all envs at once
+        values = self.value(tf.reshape(states, (-1, states.shape[-1])))
+        values = tf.reshape(values, (tf.shape(states)[0], tf.shape(states)[1], -1))
+
+        return self.policy_loss.compute_targets(values[:-1], values[1:], rewards, dones)
+
     # Get loss and Do backpropagation
-    @tf.function
-    def training_ppo(self, states, actions, rewards, dones, next_states):
+    def training_ppo(self, states, actions, advantages, returns):
         with tf.GradientTape() as tape:
             action_mean, _      = self.policy(states)
             values              = self.value(states)
             old_action_mean, _  = self.policy_old(states)
             old_values          = self.value_old(states)
-            next_values         = self.value(next_states)
 
-            loss                = self.policy_loss.compute_loss(action_mean, self.std, old_action_mean, self.std, values, old_values, next_values, actions, rewards, dones)
+            loss                = self.policy_loss.compute_loss(action_mean, self.std, old_action_mean, self.std, values, old_values, actions, advantages, returns)
 
         gradients = tape.gradient(loss, self.policy.trainable_variables + self.value.trainable_variables)        
         self.optimizer.apply_gradients(zip(gradients, self.policy.trainable_variables + self.value.trainable_variables))
 
-    @tf.function
     def training_aux(self, states):
         Returns = tf.stop_gradient(self.value(states))
 
@@ -297,13 +309,21 @@ class Agent():
 
     # Update the model
     def update_ppo(self):
+        states, actions, rewards, dones = self.policy_memory.get_all_tensor()
+        advantages, returns             = self.compute_targets(states, rewards, dones)
+
+        # The envs are only flattened for the minibatches, every epoch after the first reads the cached batches
+        dataset = tf.data.Dataset.from_tensor_slices((tf.reshape(states[:-1], (-1, states.shape[-1])), tf.reshape(actions, (-1, actions.shape[-1])),
+            tf.reshape(advantages, (-1, advantages.shape[-1])), tf.reshape(returns, (-1, returns.shape[-1]))))
+        dataset = dataset.batch(self.batchsize).cache().prefetch(tf.data.experimental.AUTOTUNE)
+
         for _ in range(self.PPO_epochs):       
-            for states, actions, rewards, dones, next_states in self.policy_memory.get_all_tensor().batch(self.batchsize):
-                self.training_ppo(states, actions, rewards, dones, next_states)
+            for states, actions, advantages, returns in dataset:
+                self.training_ppo(states, actions, advantages, returns)
 
         # Clear the memory
         states, _, _, _, _ = self.policy_memory.get_all()
-        self.aux_memory.save_all(states)
+        self.aux_memory.save_all([state for step in states for state in step])
         self.policy_memory.clear_memory()
 
         # Copy new weights into old policy:
@@ -311,9 +331,11 @@ class Agent():
         self.value_old.set_weights(self.value.get_weights())
 
     def update_aux(self):
+        dataset = self.aux_memory.get_dataset(self.batchsize)
+
         # Optimize policy for K epochs:
         for _ in range(self.PPO_epochs): 
-            for states in self.aux_memory.get_all_tensor().batch(self.batchsize):
+            for states in dataset:
                 self.training_aux(states)
 
         # Clear the memory
@@ -368,7 +390,6 @@ class VectorEnv():
 class Runner():
     def __init__(self, envs, agent, render, training_mode, n_update, n_aux_update, max_action):
         self.envs       = VectorEnv(envs)
-        self.memories   = [PolicyMemory() for _ in range(len(envs))]
 
         self.agent          = agent
         self.render         = render
@@ -394,14 +415,16 @@ class Runner():
             datas       = self.envs.step(action_gym)
 
             rewards     = []
+            dones       = []
             next_states = []
-            for state, action, memory, data in zip(states, actions, self.memories, datas):
+            for data in datas:
                 next_state, reward, done, _ = data
                 rewards.append(reward)
+                dones.append(done)
                 next_states.append(next_state)
                 
-                if self.training_mode:
-                    memory.save_eps(state.tolist(), action.tolist(), reward, float(done), next_state.tolist())
+            if self.training_mode:
+                self.agent.save_step(states, actions, rewards, dones, next_states)
             
             eps_time += 1 
             self.t_updates += 1
@@ -413,11 +436,6 @@ class Runner():
                 self.envs.render()
             
             if self.training_mode and self.n_update is not None and self.t_updates == self.n_update:
-                for memory in self.memories:
-                    temp_states, temp_actions, temp_rewards, temp_dones, temp_next_states = memory.get_all()
-                    self.agent.save_all(temp_states, temp_actions, temp_rewards, temp_dones, temp_next_states)
-                    memory.clear_memory()
-
                 self.agent.update_ppo()
                 self.t_updates = 0
                 self.t_aux_updates += 1
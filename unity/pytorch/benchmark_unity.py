@@ -0,0 +1,52 @@
+import time
+
+import ppg
+import ppg_ver2
+from mock_unity import MockUnityEnvironment
+
+def make_runner(module, n_envs, training_mode, n_update, mock_config):
+    pool = module.UnityEnvPool(lambda worker_id: MockUnityEnvironment(worker_id = worker_id, **mock_config), n_envs)
+    spec = list(pool.behavior_specs.values())[0]
+
+    state_dim   = spec.observation_shapes[0][0]
+    action_dim  = spec.action_spec.continuous_size
+
+    if module is ppg:
+        agent = module.Agent(state_dim, action_dim, training_mode, 0.03, 5, 1.0, 0.0, 1.0, 256, 4, 0.99, 0.95, 3e-4)
+        return module.Runner(pool, agent, False, training_mode, n_update, 1, 1.0), pool
+
+    envs    = module.VectorEnv(pool)
+    agent   = module.Agent(state_dim, action_dim, training_mode, 0.03, 5, 1.0, 0.0, 1.0, 256, 4, 0.99, 0.95, 3e-4, n_update, 1, envs.tracked_agents)
+    return module.Runner(envs, agent, False, training_mode, n_update, 1, 1.0), pool
+
+def measure(module, n_envs, training_mode, n_update, mock_config):
+    runner, pool = make_runner(module, n_envs, training_mode, n_update, mock_config)
+    runner.run_episode() # Warm up
+
+    start       = time.perf_counter()
+    _, n_steps  = runner.run_episode()
+    elapsed     = time.perf_counter() - start
+
+    pool.close()
+    return n_steps * n_envs * mock_config['n_agents'] / elapsed, runner.steps_per_sec
+
+def main():
+    ############## Hyperparameters ##############
+    n_update            = 256 # How many steps one episode of the runner takes
+    n_agents            = [1, 12, 64] # How many agents each mock instance has
+    n_envs              = [1, 4] # How many mock instances step side by side
+    latency             = 0.002 # Seconds every mock step blocks for, like a simulator would
+    termination_rate    = 0.01 # Chance that the episode of an agent ends on a step
+    #############################################
+    for module in [ppg, ppg_ver2]:
+        for training_mode in [False, True]:
+            for agents in n_agents:
+                for envs in n_envs:
+                    mock_config = dict(n_agents = agents, state_dim = 8, action_dim = 2, termination_rate = termination_rate, latency = latency)
+                    agent_steps, sim_steps = measure(module, envs, training_mode, n_update, mock_config)
+
+                    print('{} \t {} \t agents {} \t envs {} \t agent steps/s: {:.0f} \t sim steps/s: {:.1f}'.format(
+                        module.__name__, 'train' if training_mode else 'rollout', agents, envs, agent_steps, sim_steps))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import time
+
+import numpy as np
+
+class MockActionSpec():
+    def __init__(self, continuous_size):
+        self.continuous_size    = continuous_size
+        self.discrete_branches  = ()
+
+class MockBehaviorSpec():
+    # Both spellings the trainers read: observation_shapes with action_size, and action_spec
+    def __init__(self, state_dim, action_dim):
+        self.observation_shapes = [(state_dim,)]
+        self.action_size        = action_dim
+        self.action_spec        = MockActionSpec(action_dim)
+
+class MockSteps():
+    # The fields of DecisionSteps and TerminalSteps the trainers use. DecisionSteps have no interrupted
+    def __init__(self, agent_id, obs, reward, interrupted = None):
+        self.agent_id   = agent_id
+        self.obs        = [obs]
+        self.reward     = reward
+
+        if interrupted is not None:
+            self.interrupted = interrupted
+
+    def __len__(self):
+        return len(self.agent_id)
+
+class MockUnityEnvironment():
+    # Stands in for mlagents_envs UnityEnvironment with one behavior, so the Unity trainers run without a build.
+    # Every agent asks for a decision on every step. An agent whose episode ends is in the TerminalSteps
+    # with its last observation and, as in most ML-Agents scenes, starts again in the DecisionSteps of the same step.
+    # It takes the arguments of UnityEnvironment and keeps them, so the engine settings of a trainer can be checked
+    def __init__(self, file_name = None, worker_id = 0, seed = 1, no_graphics = False, side_channels = None,
+                 n_agents = 8, state_dim = 8, action_dim = 2, termination_rate = 0.01, interruption_rate = 0.0, latency = 0.0):
+        self.file_name          = file_name
+        self.worker_id          = worker_id
+        self.no_graphics        = no_graphics
+        self.side_channels      = side_channels if side_channels is not None else []
+
+        self.n_agents           = n_agents
+        self.state_dim          = state_dim
+        self.action_dim         = action_dim
+        self.termination_rate   = termination_rate # Chance that the episode of an agent ends on a step
+        self.interruption_rate  = interruption_rate # Share of the ended episodes that hit the step limit instead of done
+        self.latency            = latency # Seconds step blocks for, like the simulator does
+
+        self.rng                = np.random.default_rng(seed + worker_id)
+        self.behavior_name      = 'MockBehavior?team=0'
+        self.behavior_specs     = {self.behavior_name: MockBehaviorSpec(state_dim, action_dim)}
+
+        self.agent_ids          = np.arange(n_agents, dtype = np.int32)
+        self.n_steps            = 0
+        self.closed             = False
+        self.reset()
+
+    def reset(self):
+        self.states     = self.rng.standard_normal((self.n_agents, self.state_dim)).astype(np.float32)
+        self.actions    = np.zeros((self.n_agents, self.action_dim), dtype = np.float32)
+        self.decision   = MockSteps(self.agent_ids, self.states.copy(), np.zeros(self.n_agents, dtype = np.float32))
+        self.terminal   = self.empty_terminal()
+
+    def empty_terminal(self):
+        return MockSteps(np.zeros(0, dtype = np.int32), np.zeros((0, self.state_dim), dtype = np.float32), np.zeros(0, dtype = np.float32), np.zeros(0, dtype = bool))
+
+    def get_steps(self, behavior_name):
+        return self.decision, self.terminal
+
+    def set_actions(self, behavior_name, actions):
+        # An ActionTuple keeps the continuous actions in continuous
+        actions = np.asarray(getattr(actions, 'continuous', actions), dtype = np.float32)
+        if actions.shape != (len(self.decision), self.action_dim):
+            raise ValueError('Expected actions of shape {} but got {}'.format((len(self.decision), self.action_dim), actions.shape))
+
+        self.actions[:] = actions
+
+    def step(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        # The observations drift towards the actions, and the reward is higher close to the origin
+        pushes              = np.zeros_like(self.states)
+        n                   = min(self.state_dim, self.action_dim)
+        pushes[:, :n]       = self.actions[:, :n]
+
+        self.states         = 0.9 * self.states + 0.1 * pushes + 0.1 * self.rng.standard_normal(self.states.shape).astype(np.float32)
+        rewards             = -np.mean(self.states ** 2, axis = 1).astype(np.float32)
+        self.actions[:]     = 0
+        self.n_steps        += 1
+
+        ended               = self.rng.random(self.n_agents) < self.termination_rate
+        interrupted         = self.rng.random(int(ended.sum())) < self.interruption_rate
+        self.terminal       = MockSteps(self.agent_ids[ended], self.states[ended], rewards[ended], interrupted)
+
+        # The ended agents start again right away
+        self.states[ended]  = self.rng.standard_normal((int(ended.sum()), self.state_dim)).astype(np.float32)
+        rewards[ended]      = 0
+        self.decision       = MockSteps(self.agent_ids, self.states.copy(), rewards)
+
+    def close(self):
+        self.closed = True
@@ -5,16 +5,18 @@ import torch
 import torch.nn as nn
 from torch.distributions import Normal
 from torch.distributions.kl import kl_divergence
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 from torch.optim import Adam
 
 import matplotlib.pyplot as plt
 import numpy as np
 import sys
 import numpy
-
-from mlagents_envs.registry import default_registry
-from mlagents_envs.environment import UnityEnvironment
+import threading
+import time
+from queue import Queue
+import os
+import tempfile
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")  
 dataType = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
@@ -68,60 +70,603 @@ class Value_Model(nn.Module):
     def forward(self, states):
         return self.nn_layer(states)
 
+class FlatParameters():
+    # Every parameter of the model is a view into one contiguous buffer, and so are the Adam moments of them.
+    # Copying the weights into another model, to the runners or into a checkpoint is then a single tensor
+    def __init__(self, model, optimizer = None):
+        self.model      = model
+        self.optimizer  = optimizer
+        self.params     = list(model.parameters())
+        self.numels     = [param.numel() for param in self.params]
+
+        self.data       = torch.cat([param.data.reshape(-1) for param in self.params])
+        for param, data in zip(self.params, self.views(self.data)):
+            param.data  = data
+
+        self.steps, self.exp_avg, self.exp_avg_sq = None, None, None
+        if optimizer is not None:
+            # Adam only creates its state on the first step, so views are put there before it does
+            self.steps      = [torch.tensor(0.0) for _ in self.params]
+            self.exp_avg    = torch.zeros_like(self.data)
+            self.exp_avg_sq = torch.zeros_like(self.data)
+
+            for param, step, exp_avg, exp_avg_sq in zip(self.params, self.steps, self.views(self.exp_avg), self.views(self.exp_avg_sq)):
+                optimizer.state[param] = {'step': step, 'exp_avg': exp_avg, 'exp_avg_sq': exp_avg_sq}
+
+    def views(self, datas):
+        return [data.view_as(param) for data, param in zip(datas.split(self.numels), self.params)]
+
+    def copy_(self, data):
+        # An agent.pth from before the flat buffer holds the state dict of the model
+        if isinstance(data, dict):
+            self.model.load_state_dict(data)
+        else:
+            self.data.copy_(data)
+
+    def state_dict(self):
+        if self.steps is None:
+            return {'params': self.data}
+
+        return {'params': self.data, 'steps': torch.stack(self.steps), 'exp_avg': self.exp_avg, 'exp_avg_sq': self.exp_avg_sq}
+
+    def load_state_dict(self, state_dict):
+        if 'model_state_dict' in state_dict:
+            self.load_legacy_state_dict(state_dict)
+            return
+
+        self.data.copy_(state_dict['params'])
+
+        if self.steps is not None and 'steps' in state_dict:
+            for step, saved in zip(self.steps, state_dict['steps']):
+                step.copy_(saved)
+
+            self.exp_avg.copy_(state_dict['exp_avg'])
+            self.exp_avg_sq.copy_(state_dict['exp_avg_sq'])
+
+    def load_legacy_state_dict(self, state_dict):
+        # Checkpoints from before the flat buffers hold the state dicts of the model and of its optimizer.
+        # The model copies into the parameters in place, which are views of data already
+        self.model.load_state_dict(state_dict['model_state_dict'])
+
+        if self.steps is None or 'optimizer_state_dict' not in state_dict:
+            return
+
+        # The optimizer puts new tensors into its state, so they are copied back into the flat buffers
+        # and the state points at the views again
+        self.optimizer.load_state_dict(state_dict['optimizer_state_dict'])
+        for param, step, exp_avg, exp_avg_sq in zip(self.params, self.steps, self.views(self.exp_avg), self.views(self.exp_avg_sq)):
+            saved = self.optimizer.state.get(param, {})
+            if 'exp_avg' in saved:
+                step.fill_(float(saved['step']))
+                exp_avg.copy_(saved['exp_avg'])
+                exp_avg_sq.copy_(saved['exp_avg_sq'])
+
+            self.optimizer.state[param] = {'step': step, 'exp_avg': exp_avg, 'exp_avg_sq': exp_avg_sq}
+
+class FusedActorCritic():
+    # The actor of Policy_Model and Value_Model side by side in one chain of matmuls for acting.
+    # Both read the same states, so their first layers are stacked into one matrix and the later ones
+    # are joined block diagonally. It holds copies of the weights, so sync is called after they are trained
+    def __init__(self, policy, value = None, capacity = 1):
+        self.policy_layers  = [policy.nn_layer[0], policy.nn_layer[2], policy.actor_layer[0]]
+        self.value_layers   = [value.nn_layer[0], value.nn_layer[2], value.nn_layer[4]] if value is not None else []
+        self.activation     = policy.actor_layer[1]
+        self.action_dim     = self.policy_layers[-1].out_features
+        self.state_dim      = self.policy_layers[0].in_features
+
+        weight              = self.policy_layers[0].weight
+        self.weights        = []
+        self.biases         = []
+
+        for i, policy_layer in enumerate(self.policy_layers):
+            in_features     = self.state_dim if i == 0 else self.weights[-1].shape[1]
+            out_features    = policy_layer.out_features + (self.value_layers[i].out_features if value is not None else 0)
+
+            self.weights.append(torch.zeros((in_features, out_features), dtype = weight.dtype, device = weight.device))
+            self.biases.append(torch.zeros(out_features, dtype = weight.dtype, device = weight.device))
+
+        self.allocate(capacity)
+        self.sync()
+
+    def allocate(self, capacity):
+        # The input and the output of every layer are written into these, only a bigger batch allocates again.
+        # They are made outside of inference mode, so act can grow them and the plain forward pass can still write them
+        weight          = self.weights[0]
+        self.capacity   = capacity
+        with torch.inference_mode(False):
+            self.inputs     = torch.zeros((capacity, self.state_dim), dtype = weight.dtype, device = weight.device)
+            self.outputs    = [torch.zeros((capacity, weight.shape[1]), dtype = weight.dtype, device = weight.device) for weight in self.weights]
+
+    def sync(self):
+        # Copies the current weights in, the blocks off the diagonal stay zero
+        with torch.no_grad():
+            for i, policy_layer in enumerate(self.policy_layers):
+                in_features, out_features = policy_layer.in_features, policy_layer.out_features
+
+                self.weights[i][:in_features, :out_features].copy_(policy_layer.weight.t())
+                self.biases[i][:out_features].copy_(policy_layer.bias)
+
+                if self.value_layers:
+                    # The first layers of both read the states, the later ones only their own part of the layer before
+                    value_layer = self.value_layers[i]
+                    rows        = 0 if i == 0 else in_features
+
+                    self.weights[i][rows:, out_features:].copy_(value_layer.weight.t())
+                    self.biases[i][out_features:].copy_(value_layer.bias)
+
+    def __call__(self, states):
+        # Returns the actor output and the values of states, the values are None without a value network
+        states  = torch.as_tensor(np.asarray(states, dtype = np.float32)).reshape(-1, self.state_dim)
+        n       = len(states)
+
+        if n > self.capacity:
+            self.allocate(n)
+
+        datas = self.inputs[:n]
+        datas.copy_(states)
+
+        for i, (weight, bias, outputs) in enumerate(zip(self.weights, self.biases, self.outputs)):
+            datas = torch.addmm(bias, datas, weight, out = outputs[:n])
+            if i < len(self.weights) - 1:
+                datas.relu_()
+
+        # The buffers are written again by the next call, so the values are copied out
+        values = datas[:, self.action_dim:].clone() if self.value_layers else None
+        return self.activation(datas[:, :self.action_dim]), values
+
+class NextStates():
+    # next_state[t] is the state in row t + 1, except for a step that ends a segment without done.
+    # Only those boundary steps keep their own next state, so every observation is stored once
+    def __init__(self, states, slots, boundaries):
+        self.states     = states # The rows after each step, at least the last one that follows the final step
+        self.slots      = slots # Row in boundaries for a step that ends a segment, otherwise -1
+        self.boundaries = boundaries
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, _  = idx.indices(len(self))
+            next_states     = self.states[start + 1 : stop + 1]
+        else:
+            next_states     = self.states[idx + 1]
+
+        # Only a minibatch that holds the end of a segment is copied
+        slots   = self.slots[idx]
+        ends    = slots >= 0
+        if ends.any():
+            next_states         = next_states.clone()
+            next_states[ends]   = self.boundaries[slots[ends]]
+
+        return next_states
+
 class PolicyMemory(Dataset):
-    def __init__(self):
-        self.actions        = [] 
-        self.states         = []
-        self.rewards        = []
-        self.dones          = []     
-        self.next_states    = []
+    def __init__(self, state_dim, action_dim, capacity = 1024, states = None):
+        self.size           = 0
+
+        self.actions        = np.zeros((capacity, action_dim), dtype = np.float32)
+        self.action_means   = np.zeros((capacity, action_dim), dtype = np.float32) # What the policy gave when it acted, which is still the old policy at the update
+        self.logprobs       = np.zeros((capacity, action_dim), dtype = np.float32)
+        self.values         = np.zeros((capacity, 1), dtype = np.float32)
+        self.states         = states if states is not None else np.zeros((capacity + 1, state_dim), dtype = np.float32) # The spare row holds the next state of the last step
+        self.rewards        = np.zeros((capacity, 1), dtype = np.float32)
+        self.dones          = np.zeros((capacity, 1), dtype = bool)
+        self.slots          = np.full(capacity, -1, dtype = np.int64)
+        self.boundaries     = []
 
     def __len__(self):
-        return len(self.dones)
+        return self.size
 
     def __getitem__(self, idx):
-        return np.array(self.states[idx], dtype = np.float32), np.array(self.actions[idx], dtype = np.float32), \
-            np.array([self.rewards[idx]], dtype = np.float32), np.array([self.dones[idx]], dtype = np.float32), np.array(self.next_states[idx], dtype = np.float32)      
+        next_state = self.boundaries[self.slots[idx]] if self.slots[idx] >= 0 else self.states[idx + 1]
+        return self.states[idx], self.actions[idx], self.action_means[idx], self.logprobs[idx], self.values[idx], self.rewards[idx], self.dones[idx], next_state
 
     def get_all(self):
-        return self.states, self.actions, self.rewards, self.dones, self.next_states        
+        # Only the state after the final step is sent along with the boundaries, the rest are already in states
+        return self.states[:self.size], self.actions[:self.size], self.action_means[:self.size], self.logprobs[:self.size], self.values[:self.size], \
+            self.rewards[:self.size], self.dones[:self.size], NextStates(self.states[self.size : self.size + 1], self.slots[:self.size], self.get_boundaries())
+
+    def get_all_tensor(self):
+        # torch.from_numpy shares the buffer, so these are views and not copies
+        states, actions, action_means, logprobs, values, rewards, dones, next_states = self.get_all()
+        next_states = NextStates(torch.from_numpy(self.states[:self.size + 1]), torch.from_numpy(next_states.slots), torch.from_numpy(next_states.boundaries))
+
+        return torch.from_numpy(states), torch.from_numpy(actions), torch.from_numpy(action_means), torch.from_numpy(logprobs), torch.from_numpy(values), \
+            torch.from_numpy(rewards), torch.from_numpy(dones), next_states
+
+    def get_boundaries(self):
+        return np.array(self.boundaries, dtype = self.states.dtype).reshape((-1,) + self.states.shape[1:])
     
-    def save_all(self, states, actions, rewards, dones, next_states):
-        self.actions = self.actions + actions
-        self.states = self.states + states
-        self.rewards = self.rewards + rewards
-        self.dones = self.dones + dones
-        self.next_states = self.next_states + next_states
+    def save_all(self, states, actions, action_means, logprobs, values, rewards, dones, next_states):
+        if len(dones) == 0:
+            return
+
+        start, end = self.reserve(len(dones))
+        self.split(start, states[0])
+
+        self.actions[start:end]         = np.reshape(actions, (end - start, -1))
+        self.action_means[start:end]    = np.reshape(action_means, (end - start, -1))
+        self.logprobs[start:end]        = np.reshape(logprobs, (end - start, -1))
+        self.values[start:end]          = np.reshape(values, (-1, 1))
+        self.states[start:end]          = states
+        self.states[end]                = next_states.states[-1]
+        self.rewards[start:end]         = np.reshape(rewards, (-1, 1))
+        self.dones[start:end]           = np.reshape(dones, (-1, 1))
+        self.slots[start:end]           = np.where(next_states.slots < 0, -1, next_states.slots + len(self.boundaries))
+
+        self.boundaries.extend(next_states.boundaries)
     
-    def save_eps(self, state, action, reward, done, next_state):
-        self.rewards.append(reward)
-        self.states.append(state)
-        self.actions.append(action)
-        self.dones.append(done)
-        self.next_states.append(next_state)
+    def save_eps(self, state, action, action_mean, logprob, value, reward, done, next_state):
+        idx, _ = self.reserve(1)
+        self.split(idx, state)
+
+        self.actions[idx]       = action
+        self.action_means[idx]  = action_mean
+        self.logprobs[idx]      = logprob
+        self.values[idx]        = value
+        self.states[idx]        = state
+        self.states[idx + 1]    = next_state
+        self.rewards[idx]       = reward
+        self.dones[idx]         = done
+        self.slots[idx]         = -1
+
+    def clear_memory(self, states = None):
+        # The aux memory keeps the filled states, so the next rollout is written into the storage it hands back
+        if states is not None:
+            self.states = states
+
+        self.size = 0
+        del self.boundaries[:]
+
+    def capacity(self):
+        return len(self.dones)
 
-    def clear_memory(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.rewards[:]
-        del self.dones[:]
-        del self.next_states[:]  
+    def reserve(self, n):
+        start       = self.size
+        self.size   = start + n
+
+        # Only grows when a rollout is longer than the preallocated capacity
+        if self.size > self.capacity():
+            self.resize(max(self.size, 2 * self.capacity()))
+
+        return start, self.size
+
+    def split(self, idx, state):
+        # A step that does not go on from the one before means that one ended a segment,
+        # so its next state is moved out of the row the new step is written into.
+        # The state is compared in the dtype the rows are stored in, a float64 observation never equals its float32 row
+        if idx > 0 and not self.dones[idx - 1] and not np.array_equal(self.states[idx], np.asarray(state, dtype = self.states.dtype)):
+            self.slots[idx - 1] = len(self.boundaries)
+            self.boundaries.append(self.states[idx].copy())
+
+    def resize(self, capacity):
+        # states keeps its spare row
+        extra = capacity - self.capacity()
+
+        for name in ['actions', 'action_means', 'logprobs', 'values', 'states', 'rewards', 'dones', 'slots']:
+            datas       = getattr(self, name)
+            new_datas   = np.zeros((len(datas) + extra,) + datas.shape[1:], dtype = datas.dtype)
+
+            new_datas[:len(datas)] = datas
+            setattr(self, name, new_datas)
+
+class AgentMemory(PolicyMemory):
+    # Every tracked agent writes into its own region of n_update rows, so its steps stay in order
+    # and the rollout of all agents is already one contiguous block when the update reads it
+    def __init__(self, state_dim, action_dim, agent_ids, n_update, states = None):
+        super(AgentMemory, self).__init__(state_dim, action_dim, n_update * len(agent_ids), states)
+
+        self.n_update   = n_update
+        self.tracked    = np.sort(agent_ids)
+        self.cursors    = np.zeros(len(self.tracked), dtype = np.int64)
+        self.agent_ids  = np.zeros(self.capacity(), dtype = np.int64)
+
+    def get_all(self):
+        self.compact()
+        return super(AgentMemory, self).get_all()
+
+    def save_agents(self, state_ids, states, actions, action_means, logprobs, values, next_ids, rewards, dones, next_states):
+        # Saves the step of every tracked agent that acted and got a new observation, all in one go
+        agent_ids, i_states, i_nexts    = np.intersect1d(state_ids, next_ids, return_indices = True)
+        slots                           = np.minimum(np.searchsorted(self.tracked, agent_ids), len(self.tracked) - 1)
+
+        kept                            = (self.tracked[slots] == agent_ids) & (self.cursors[slots] < self.n_update)
+        agent_ids, i_states, i_nexts    = agent_ids[kept], i_states[kept], i_nexts[kept]
+        slots                           = slots[kept]
+
+        if len(slots) == 0:
+            return
+
+        rows        = slots * self.n_update + self.cursors[slots]
+        states      = np.asarray(states, dtype = self.states.dtype)[i_states]
+        next_states = np.asarray(next_states, dtype = self.states.dtype)[i_nexts]
+
+        # The same as split in save_eps, an agent that does not go on from its last step ended a segment there
+        started = self.cursors[slots] > 0
+        prev    = rows[started] - 1
+        ended   = ~self.dones[prev, 0] & np.any(self.states[prev + 1] != states[started], axis = 1)
+        self.add_boundaries(prev[ended], self.states[prev[ended] + 1])
+
+        self.agent_ids[rows]    = agent_ids
+        self.actions[rows]      = np.reshape(np.asarray(actions)[i_states], (len(rows), -1))
+        self.action_means[rows] = np.reshape(np.asarray(action_means)[i_states], (len(rows), -1))
+        self.logprobs[rows]     = np.reshape(np.asarray(logprobs)[i_states], (len(rows), -1))
+        self.values[rows, 0]    = np.asarray(values)[i_states]
+        self.states[rows]       = states
+        self.rewards[rows, 0]   = np.asarray(rewards)[i_nexts]
+        self.dones[rows, 0]     = np.asarray(dones)[i_nexts]
+        self.slots[rows]        = -1
+
+        # The next state goes into the following row of the region, or aside after the last row of the region
+        last                        = self.cursors[slots] == self.n_update - 1
+        self.states[rows[~last] + 1] = next_states[~last]
+        self.add_boundaries(rows[last], next_states[last])
+
+        self.cursors[slots] += 1
+
+    def add_boundaries(self, rows, next_states):
+        self.slots[rows] = np.arange(len(self.boundaries), len(self.boundaries) + len(rows))
+        self.boundaries.extend(np.array(next_states, dtype = self.states.dtype))
+
+    def compact(self):
+        # An agent that missed steps leaves a gap at the end of its region, so the regions after it are moved up
+        if self.size == self.cursors.sum():
+            return
+
+        self.size = 0
+        for slot, cursor in enumerate(self.cursors):
+            start = slot * self.n_update
+
+            if 0 < cursor < self.n_update:
+                self.add_boundaries([start + cursor - 1], self.states[start + cursor : start + cursor + 1])
+
+            if self.size < start:
+                for name in ['agent_ids', 'actions', 'action_means', 'logprobs', 'values', 'states', 'rewards', 'dones', 'slots']:
+                    datas = getattr(self, name)
+                    datas[self.size : self.size + cursor] = datas[start : start + cursor]
+
+            self.size += cursor
+
+    def clear_memory(self, states = None):
+        super(AgentMemory, self).clear_memory(states)
+        self.cursors[:] = 0
+
+def get_rss():
+    # Resident memory of this process in bytes, or 0 where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
 
 class AuxMemory(Dataset):
-    def __init__(self):
-        self.states = []
+    def __init__(self, state_dim, capacity = 5120, rss_budget = None, spill_dir = None):
+        self.size           = 0
+        self.cursor         = 0
+        self.start          = 0
+        self.contiguous     = True
+
+        self.rss_budget     = rss_budget # In bytes. Past it the storage is moved to a temporary file in spill_dir
+        self.spill_dir      = spill_dir
+        self.spilled_bytes  = 0
+
+        self.storage        = np.zeros((capacity, state_dim), dtype = np.float32)
+        self.chunks         = []
+
+        # The storage is not touched yet, so it is counted as if it was already filled
+        if self.rss_budget is not None and get_rss() + self.storage.nbytes > self.rss_budget:
+            self.spill()
 
     def __len__(self):
-        return len(self.states)
+        return self.size
 
     def __getitem__(self, idx):
-        return np.array(self.states[idx], dtype = np.float32)
+        return self.get_all()[idx]
+
+    def next_chunk(self, n):
+        # The policy memory writes its next phase straight into this slice of the storage.
+        # It starts over from the beginning once the aux cycle has been consumed
+        if len(self.chunks) == 0 or self.cursor + n > len(self.storage):
+            self.cursor = 0
+
+        if n <= len(self.storage) and self.is_free(self.cursor, n):
+            return self.storage[self.cursor : self.cursor + n]
+
+        # The storage is still held by chunks of this aux cycle, so the phase gets its own buffer
+        return np.zeros((n, self.storage.shape[1]), dtype = np.float32)
+
+    def get_all(self):
+        if len(self.chunks) == 1:
+            return self.chunks[0]
+
+        if self.contiguous:
+            return self.storage[self.start : self.start + self.size]
+
+        return np.concatenate(self.chunks)
+
+    def get_all_tensor(self):
+        return torch.from_numpy(self.get_all())
 
     def save_all(self, states):
-        self.states = self.states + states
+        # Only a reference to the chunk is kept, the states are never copied here
+        if len(states) == 0:
+            return
+
+        offset = self.offset(states)
+
+        if len(self.chunks) == 0:
+            self.start      = offset
+            self.contiguous = offset is not None
+        else:
+            self.contiguous = self.contiguous and offset == self.start + self.size
+
+        if offset == self.cursor:
+            self.cursor += len(states)
+
+        if offset is not None and self.on_disk():
+            self.spilled_bytes += states.nbytes
+
+        self.chunks.append(states)
+        self.size += len(states)
 
     def clear_memory(self):
-        del self.states[:]
+        self.size           = 0
+        self.spilled_bytes  = 0 # Counted per aux phase
+        del self.chunks[:]
+
+        # Only checked between aux cycles, when none of the storage is in use
+        if self.rss_budget is not None and not self.on_disk() and get_rss() > self.rss_budget:
+            self.spill()
+
+    def on_disk(self):
+        return isinstance(self.storage, np.memmap)
+
+    def spill(self):
+        # The policy memory then writes its states straight into the file and update_aux reads them back in order
+        self.file       = tempfile.TemporaryFile(dir = self.spill_dir)
+        self.storage    = np.memmap(self.file, dtype = self.storage.dtype, mode = 'w+', shape = self.storage.shape)
+
+        print('Aux memory is over the RSS budget, its states are kept on disk from now on')
+
+    def is_free(self, start, n):
+        for chunk in self.chunks:
+            offset = self.offset(chunk)
+            if offset is not None and start < offset + len(chunk) and offset < start + n:
+                return False
+
+        return True
+
+    def offset(self, states):
+        # Row of the storage where states begins, or None if states was not handed out by next_chunk
+        if len(states) == 0 or not np.may_share_memory(states, self.storage):
+            return None
+
+        return (states.ctypes.data - self.storage.ctypes.data) // self.storage.strides[0]
+
+class MinibatchSampler():
+    def __init__(self, batchsize, shuffle = False):
+        self.batchsize  = batchsize
+        self.shuffle    = shuffle
+
+    def sample(self, n):
+        # Yields slices, or chunks of one index permutation when shuffling,
+        # so each minibatch is gathered from the whole tensors in a single indexing op
+        if self.shuffle:
+            indices = torch.randperm(n)
+            for start in range(0, n, self.batchsize):
+                yield indices[start : start + self.batchsize]
+
+        else:
+            for start in range(0, n, self.batchsize):
+                yield slice(start, start + self.batchsize)
+
+class MinibatchPrefetcher():
+    def __init__(self, sampler, device, depth = 2):
+        self.sampler    = sampler
+        self.device     = device
+        self.depth      = depth # How many minibatches are assembled ahead of the training step
+
+        self.pinned     = device.type == 'cuda'
+        self.stream     = torch.cuda.Stream(device) if self.pinned else None
+        self.consumer   = None
+        self.key        = None
+        self.slots      = []
+
+        self.fetch_time = 0.0
+        self.wait_time  = 0.0
+        self.overlap    = 0.0 # Share of the time spent assembling minibatches that was hidden behind training
+
+    def prefetch(self, datas, expands = None):
+        # Yields the minibatches of datas on the device while a background thread gathers, converts and copies the next ones.
+        # A field with an expand function keeps its own dtype and is expanded after the copy, the others become float32
+        expands = expands if expands is not None else (None,) * len(datas)
+        self.allocate(datas, expands)
+
+        queue           = Queue(self.depth)
+        self.consumer   = torch.cuda.current_stream(self.device) if self.pinned else None
+        self.fetch_time = 0.0
+        self.wait_time  = 0.0
+
+        thread = threading.Thread(target = self.produce, args = (queue, datas, expands), daemon = True)
+        thread.start()
+
+        while True:
+            start           = time.perf_counter()
+            batch           = queue.get()
+            self.wait_time  += time.perf_counter() - start
+
+            if batch is None:
+                break
+
+            if isinstance(batch, Exception):
+                raise batch
+
+            batch, event = batch
+            if event is not None:
+                self.consumer.wait_event(event)
+
+            yield batch
+
+        thread.join()
+        self.overlap = 1.0 - min(self.wait_time / self.fetch_time, 1.0) if self.fetch_time > 0 else 0.0
+
+    def produce(self, queue, datas, expands):
+        try:
+            for i, idx in enumerate(self.sampler.sample(len(datas[0]))):
+                start           = time.perf_counter()
+                batch           = self.fetch(self.slots[i % len(self.slots)], datas, expands, idx)
+                self.fetch_time += time.perf_counter() - start
+
+                queue.put(batch)
+
+            queue.put(None)
+
+        except Exception as e:
+            queue.put(e)
+
+    def fetch(self, slot, datas, expands, idx):
+        buffers, event = slot
+
+        # The staging buffers of a slot are reused only after the copies out of them are done
+        if event is not None:
+            event.synchronize()
+
+        staged = []
+        for buffer, data in zip(buffers, datas):
+            rows = data[idx]
+            staged.append(buffer[:len(rows)].copy_(rows))
+
+        if self.stream is None:
+            staged = [datas.to(self.device) for datas in staged]
+            return tuple(expand(datas) if expand is not None else datas for datas, expand in zip(staged, expands)), None
+
+        with torch.cuda.stream(self.stream):
+            batch = []
+            for datas, expand in zip(staged, expands):
+                datas = datas.to(self.device, non_blocking = True)
+                datas = expand(datas) if expand is not None else datas
+
+                datas.record_stream(self.consumer)
+                batch.append(datas)
+
+            event.record(self.stream)
+
+        return tuple(batch), event
+
+    def allocate(self, datas, expands):
+        # One set of staging buffers for each minibatch that can be in flight: queued, being trained on and being filled
+        samples = [data[0:1] for data in datas]
+        key     = tuple((sample.shape[1:], sample.dtype if expand is not None else torch.float32) for sample, expand in zip(samples, expands))
+
+        if key == self.key:
+            return
+
+        self.key    = key
+        self.slots  = []
+        for _ in range(self.depth + 2):
+            buffers = tuple(torch.empty((self.sampler.batchsize,) + shape, dtype = dtype, pin_memory = self.pinned) for shape, dtype in key)
+            self.slots.append((buffers, torch.cuda.Event() if self.pinned else None))
 
 class Continous():
     def sample(self, mean, std):
@@ -142,35 +687,69 @@ class Continous():
 
         return kl_divergence(distribution1, distribution2).float().to(device)  
 
+class ContinousSampler():
+    # Draws the actions of act as mean + std * noise, without a Normal on every step.
+    # The noise goes into a buffer that is kept between steps, and the log probability is taken from the noise
+    def __init__(self, std, capacity = 1):
+        self.std        = std
+        self.log_std    = std.log() + 0.5 * np.log(2 * np.pi)
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        # Made outside of inference mode, so the buffer can be written in or out of it
+        with torch.inference_mode(False):
+            self.capacity   = capacity
+            self.noise      = torch.zeros((capacity, self.std.shape[1]), device = self.std.device)
+
+    def sample(self, action_mean, training_mode = True):
+        n = len(action_mean)
+        if n > self.capacity:
+            self.allocate(n)
+
+        # The mean itself is the action in Test Mode, which is the same as no noise
+        noise       = self.noise[:n].normal_() if training_mode else self.noise[:n].zero_()
+
+        # log N(mean + std * noise | mean, std) = -noise^2 / 2 - log(std) - log(2 pi) / 2
+        actions     = torch.addcmul(action_mean, noise, self.std)
+        logprobs    = noise.square().mul_(-0.5).sub_(self.log_std)
+        return actions, logprobs
+
 class PolicyFunction():
     def __init__(self, gamma = 0.99, lam = 0.95):
         self.gamma  = gamma
         self.lam    = lam
 
+    def backward_scan(self, datas, factors):
+        # Solves y[t] = datas[t] + factors[t] * y[t + 1] for every step at once.
+        # Each pass folds in the steps twice as far ahead, so a rollout takes log2(n) passes instead of n
+        shift = 1
+        while shift < len(datas):
+            datas   = torch.cat([datas[:-shift] + factors[:-shift] * datas[shift:], datas[-shift:]])
+            factors = torch.cat([factors[:-shift] * factors[shift:], factors[-shift:]])
+            shift   *= 2
+
+        return datas
+
     def monte_carlo_discounted(self, rewards, dones):
-        running_add = 0
-        returns     = []        
-        
-        for step in reversed(range(len(rewards))):
-            running_add = rewards[step] + (1.0 - dones[step]) * self.gamma * running_add
-            returns.insert(0, running_add)
-            
-        return torch.stack(returns)
+        return self.backward_scan(rewards, (1.0 - dones) * self.gamma)
       
     def temporal_difference(self, reward, next_value, done):
         q_values = reward + (1 - done) * self.gamma * next_value           
         return q_values
       
-    def generalized_advantage_estimation(self, values, rewards, next_values, dones):
-        gae     = 0
-        adv     = []     
+    def generalized_advantage_estimation(self, values, rewards, next_values, dones, ends = None):
+        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values
+        factors = (1.0 - dones) * self.gamma * self.lam
 
-        delta   = rewards + (1.0 - dones) * self.gamma * next_values - values          
-        for step in reversed(range(len(rewards))):
-            gae = delta[step] + (1.0 - dones[step]) * self.gamma * self.lam * gae
-            adv.insert(0, gae)
-            
-        return torch.stack(adv)
+        # A step whose next state is not in the following row ends its segment, so its advantage does not run on into that row
+        if ends is not None:
+            factors = factors.masked_fill(ends, 0.0)
+
+        return self.backward_scan(delta, factors)
+
+    def lambda_returns(self, values, rewards, next_values, dones):
+        # TD(lambda) targets, the value plus its GAE advantage
+        return self.generalized_advantage_estimation(values, rewards, next_values, dones) + values
 
 class TrulyPPO():
     def __init__(self, policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam):
@@ -183,19 +762,22 @@ class TrulyPPO():
         self.distributions      = Continous()
         self.policy_function    = PolicyFunction(gamma, lam)
 
-    def compute_loss(self, action_mean, action_std, old_action_mean, old_action_std, values, old_values, next_values, actions, rewards, dones):    
+    def compute_targets(self, values, next_values, rewards, dones, ends):
+        # Getting general advantages estimator and returns of the whole rollout
+        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones, ends)
+        Returns         = Advantages + values
+        Advantages      = (Advantages - Advantages.mean()) / (Advantages.std() + 1e-6)
+
+        return Advantages, Returns
+
+    def compute_loss(self, action_mean, action_std, old_action_mean, old_action_std, old_logprobs, values, old_values, actions, Advantages, Returns):    
         # Don't use old value in backpropagation
         Old_values          = old_values.detach()
         Old_action_mean     = old_action_mean.detach()
 
-        # Getting general advantages estimator and returns
-        Advantages      = self.policy_function.generalized_advantage_estimation(values, rewards, next_values, dones)
-        Returns         = (Advantages + values).detach()
-        Advantages      = ((Advantages - Advantages.mean()) / (Advantages.std() + 1e-6)).detach() 
-
         # Finding the ratio (pi_theta / pi_theta__old):      
         logprobs        = self.distributions.logprob(action_mean, action_std, actions)
-        Old_logprobs    = self.distributions.logprob(Old_action_mean, old_action_std, actions).detach() 
+        Old_logprobs    = old_logprobs.detach()
 
         # Finding Surrogate Loss
         ratios          = (logprobs - Old_logprobs).exp() # ratios = old_logprobs / logprobs        
@@ -254,17 +836,21 @@ class Agent():
         self.std                = torch.ones([1, action_dim]).float().to(device) * 0.5
 
         self.policy             = Policy_Model(state_dim, action_dim)
-        self.policy_old         = Policy_Model(state_dim, action_dim)
         self.policy_optimizer   = Adam(self.policy.parameters(), lr = learning_rate)
+        self.policy_flat        = FlatParameters(self.policy, self.policy_optimizer)
 
         self.value              = Value_Model(state_dim, action_dim)
-        self.value_old          = Value_Model(state_dim, action_dim)
         self.value_optimizer    = Adam(self.value.parameters(), lr = learning_rate)
+        self.value_flat         = FlatParameters(self.value, self.value_optimizer)
+        self.fused              = FusedActorCritic(self.policy, self.value)
 
         self.policy_loss        = TrulyPPO(policy_kl_range, policy_params, value_clip, vf_loss_coef, entropy_coef, gamma, lam)
         self.aux_loss           = JointAux()
+        self.sampler            = MinibatchSampler(batchsize)
+        self.prefetcher         = MinibatchPrefetcher(self.sampler, device)
          
         self.distributions      = Continous()
+        self.action_sampler     = ContinousSampler(self.std)
 
         if is_training_mode:
           self.policy.train()
@@ -273,29 +859,51 @@ class Agent():
           self.policy.eval()
           self.value.eval()
 
-    def act(self, state):
-        state           = torch.FloatTensor(state).unsqueeze(0).to(device).detach()
-        action_mean, _  = self.policy(state)
-        
-        # We don't need sample the action in Test Mode
-        # only sampling the action in Training Mode in order to exploring the actions
-        if self.is_training_mode:
-            # Sample the action
-            action  = self.distributions.sample(action_mean, self.std)
-        else:
-            action  = action_mean  
-              
-        return action.squeeze(0).cpu().numpy()
+    def act(self, states):
+        # Takes the states of every agent that asked for a decision, row i of the outputs belongs to row i of states
+        with torch.inference_mode():
+            action_means, values    = self.fused(states)
+
+            # We don't need sample the action in Test Mode
+            # only sampling the action in Training Mode in order to exploring the actions
+            actions, logprobs       = self.action_sampler.sample(action_means, self.is_training_mode)
+
+        # The networks only change in update_ppo, so until then these are what the update compares against
+        return actions.cpu().numpy(), action_means.cpu().numpy(), logprobs.cpu().numpy(), values.squeeze(1).cpu().numpy()
+
+    def compute_targets(self, values, rewards, dones, next_states):
+        # Every step already has its value from act, only the states after the last step of each agent are valued here
+        with torch.no_grad():
+            tails = self.value(torch.cat([next_states.states[-1:], next_states.boundaries]).float().to(device)).cpu()
+
+        ends                = next_states.slots >= 0
+        next_values         = torch.cat([values[1:], tails[:1]])
+        next_values[ends]   = tails[1:][next_states.slots[ends]]
+
+        advantages, returns = self.policy_loss.compute_targets(values.to(device), next_values.to(device), rewards.to(device), dones.float().to(device), ends.unsqueeze(1).to(device))
+
+        # The prefetcher gathers the minibatches on the host
+        return advantages.cpu(), returns.cpu()
+
+    def compute_aux_targets(self, states):
+        # Both targets of the aux phase stay fixed while it runs, the value network is not trained
+        # and the old policy is the policy as it starts, so they are computed once up front
+        returns, old_action_means = [], []
+
+        with torch.no_grad():
+            for start in range(0, len(states), self.batchsize):
+                batch = states[start : start + self.batchsize].float().to(device)
+                returns.append(self.value(batch).cpu())
+                old_action_means.append(self.policy(batch)[0].cpu())
+
+        return torch.cat(returns), torch.cat(old_action_means)
 
     # Get loss and Do backpropagation
-    def training_ppo(self, states, actions, rewards, dones, next_states):
+    def training_ppo(self, states, actions, old_action_mean, old_logprobs, old_values, advantages, returns):
         action_mean, _      = self.policy(states)
         values              = self.value(states)
-        old_action_mean, _  = self.policy_old(states)
-        old_values          = self.value_old(states)
-        next_values         = self.value(next_states)
 
-        loss                = self.policy_loss.compute_loss(action_mean, self.std, old_action_mean, self.std, values, old_values, next_values, actions, rewards, dones)
+        loss                = self.policy_loss.compute_loss(action_mean, self.std, old_action_mean, self.std, old_logprobs, values, old_values, actions, advantages, returns)
 
         self.policy_optimizer.zero_grad()
         self.value_optimizer.zero_grad()
@@ -305,11 +913,8 @@ class Agent():
         self.policy_optimizer.step()
         self.value_optimizer.step()
 
-    def training_aux(self, states):
-        Returns                         = self.value(states).detach()
-
+    def training_aux(self, states, Returns, old_action_mean):
         action_mean, values             = self.policy(states)
-        old_action_mean, _              = self.policy_old(states)
 
         joint_loss                      = self.aux_loss.compute_loss(action_mean, self.std, old_action_mean, self.std, values, Returns)
 
@@ -319,62 +924,173 @@ class Agent():
 
     # Update the model
     def update_ppo(self, policy_memory, aux_memory):
-        dataloader  = DataLoader(policy_memory, self.batchsize, shuffle = False)
+        states, actions, action_means, logprobs, values, rewards, dones, next_states = policy_memory.get_all_tensor()
+        advantages, returns = self.compute_targets(values, rewards, dones, next_states)
 
         # Optimize policy for K epochs:
         for _ in range(self.PPO_epochs):
-            for states, actions, rewards, dones, next_states in dataloader:
-                self.training_ppo(states.float().to(device), actions.float().to(device), rewards.float().to(device), dones.float().to(device), next_states.float().to(device))
+            for batch in self.prefetcher.prefetch((states, actions, action_means, logprobs, values, advantages, returns)):
+                self.training_ppo(*batch)
 
         # Clear the memory
-        states, _, _, _, _ = policy_memory.get_all()
-        aux_memory.save_all(states)
-        policy_memory.clear_memory()
+        aux_memory.save_all(policy_memory.get_all()[0])
+        policy_memory.clear_memory(aux_memory.next_chunk(policy_memory.capacity() + 1))
 
-        # Copy new weights into old policy:
-        self.policy_old.load_state_dict(self.policy.state_dict())
-        self.value_old.load_state_dict(self.value.state_dict())
+        # act runs on a copy of the weights
+        self.fused.sync()
 
         return policy_memory, aux_memory
 
     def update_aux(self, aux_memory):
-        dataloader  = DataLoader(aux_memory, self.batchsize, shuffle = False)
+        states                      = aux_memory.get_all_tensor()
+        returns, old_action_means   = self.compute_aux_targets(states)
 
         # Optimize policy for K epochs:
         for _ in range(self.PPO_epochs):       
-            for states in dataloader:
-                self.training_aux(states.float().to(device))
+            for batch in self.prefetcher.prefetch((states, returns, old_action_means)):
+                self.training_aux(*batch)
+
+        if aux_memory.on_disk():
+            print('Aux states spilled to disk: {:.1f} MB'.format(aux_memory.spilled_bytes / 2 ** 20))
 
         # Clear the memory
         aux_memory.clear_memory()
 
-        # Copy new weights into old policy:
-        self.policy_old.load_state_dict(self.policy.state_dict())
+        self.fused.sync()
 
         return aux_memory
 
     def save_weights(self):
-        torch.save({
-            'model_state_dict': self.policy.state_dict(),
-            'optimizer_state_dict': self.policy_optimizer.state_dict()
-            }, 'SlimeVolley/policy.tar')
+        torch.save(self.policy_flat.state_dict(), 'SlimeVolley/policy.tar')
         
-        torch.save({
-            'model_state_dict': self.value.state_dict(),
-            'optimizer_state_dict': self.value_optimizer.state_dict()
-            }, 'SlimeVolley/value.tar')
+        torch.save(self.value_flat.state_dict(), 'SlimeVolley/value.tar')
         
     def load_weights(self):
-        policy_checkpoint = torch.load('SlimeVolley/policy.tar')
-        self.policy.load_state_dict(policy_checkpoint['model_state_dict'])
-        self.policy_optimizer.load_state_dict(policy_checkpoint['optimizer_state_dict'])
-
-        value_checkpoint = torch.load('SlimeVolley/value.tar')
-        self.value.load_state_dict(value_checkpoint['model_state_dict'])
-        self.value_optimizer.load_state_dict(value_checkpoint['optimizer_state_dict'])
+        self.policy_flat.load_state_dict(torch.load('SlimeVolley/policy.tar', map_location = device))
+        self.value_flat.load_state_dict(torch.load('SlimeVolley/value.tar', map_location = device))
+        self.fused.sync()
+
+class EngineConfig():
+    # How the simulator runs while training, sent to every instance through an EngineConfigurationChannel.
+    # Without it a build runs in real time and renders every frame
+    def __init__(self, time_scale = 20.0, target_frame_rate = -1, quality_level = 0, no_graphics = True):
+        self.time_scale         = time_scale
+        self.target_frame_rate  = target_frame_rate
+        self.quality_level      = quality_level
+        self.no_graphics        = no_graphics
+
+    def channel(self):
+        from mlagents_envs.side_channel.engine_configuration_channel import EngineConfigurationChannel
+
+        channel = EngineConfigurationChannel()
+        channel.set_configuration_parameters(quality_level = self.quality_level, time_scale = self.time_scale, target_frame_rate = self.target_frame_rate)
+        return channel
+
+def make_env(env_file, worker_id, engine_config = None):
+    # ML-Agents is only imported once a real build is started, the pool and the trainers also run on a mock environment
+    from mlagents_envs.environment import UnityEnvironment
+
+    if engine_config is None:
+        return UnityEnvironment(file_name = env_file, seed = 1 + worker_id, worker_id = worker_id)
+
+    return UnityEnvironment(file_name = env_file, seed = 1 + worker_id, worker_id = worker_id, no_graphics = engine_config.no_graphics,
+        side_channels = [engine_config.channel()])
+
+class PooledSteps():
+    # The DecisionSteps or TerminalSteps of every instance of a pool joined into one batch
+    def __init__(self, agent_id, obs, reward, interrupted):
+        self.agent_id       = agent_id
+        self.obs            = obs
+        self.reward         = reward
+        self.interrupted    = interrupted
+
+class UnityEnvPool():
+    # n_envs Unity instances that look like one UnityEnvironment holding all of their agents.
+    # Every instance gets its own worker_id and its own thread, so their blocking step calls run at the same time.
+    # Agent ids are made unique across the pool as local id * n_envs + index of the instance
+    def __init__(self, make_env, n_envs = 1):
+        self.envs       = [make_env(worker_id) for worker_id in range(n_envs)]
+        self.counts     = [0] * n_envs # How many rows of the last DecisionSteps belong to each instance
+        self.requests   = []
+        self.replies    = Queue()
+
+        # A single instance is called directly
+        if n_envs > 1:
+            for env in self.envs:
+                requests = Queue()
+                threading.Thread(target = self.work, args = (env, requests), daemon = True).start()
+                self.requests.append(requests)
+
+    @property
+    def behavior_specs(self):
+        # Every instance runs the same build
+        return self.envs[0].behavior_specs
+
+    def work(self, env, requests):
+        while True:
+            command = requests.get()
+            if command is None:
+                break
+
+            try:
+                getattr(env, command)()
+                self.replies.put(None)
+            except Exception as e:
+                self.replies.put(e)
+
+    def call(self, command):
+        # Runs the command on every instance and waits until all of them are done
+        if len(self.requests) == 0:
+            for env in self.envs:
+                getattr(env, command)()
+            return
+
+        for requests in self.requests:
+            requests.put(command)
+
+        errors = [self.replies.get() for _ in self.requests]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def merge(self, steps):
+        n_envs      = len(self.envs)
+        agent_id    = np.concatenate([np.asarray(step.agent_id, dtype = np.int64) * n_envs + i for i, step in enumerate(steps)])
+        obs         = [np.concatenate(datas) for datas in zip(*[step.obs for step in steps])]
+        reward      = np.concatenate([step.reward for step in steps])
+
+        # DecisionSteps have no interrupted
+        interrupted = np.concatenate([getattr(step, 'interrupted', np.zeros(len(step.agent_id), dtype = bool)) for step in steps])
+        return PooledSteps(agent_id, obs, reward, interrupted)
+
+    def reset(self):
+        self.call('reset')
+
+    def step(self):
+        self.call('step')
+
+    def get_steps(self, behavior_name):
+        decisions, terminals    = zip(*[env.get_steps(behavior_name) for env in self.envs])
+        self.counts             = [len(step.agent_id) for step in decisions]
+
+        return self.merge(decisions), self.merge(terminals)
+
+    def set_actions(self, behavior_name, actions):
+        # The rows come in the order of the last get_steps, one instance after the other
+        for env, datas in zip(self.envs, np.split(np.asarray(actions), np.cumsum(self.counts)[:-1])):
+            if len(datas) > 0:
+                env.set_actions(behavior_name, datas)
+
+    def close(self):
+        self.call('close')
+
+        for requests in self.requests:
+            requests.put(None)
+
+        self.requests = []
 
 class Runner():
-    def __init__(self, env, agent, render, training_mode, n_update, n_aux_update, max_action):
+    def __init__(self, env, agent, render, training_mode, n_update, n_aux_update, max_action, rss_budget = None):
         self.env = env
         self.agent = agent
         self.render = render
@@ -385,85 +1101,85 @@ class Runner():
 
         self.t_updates = 0
         self.t_aux_updates = 0
+        self.steps_per_sec = 0.0 # How many steps the simulator made per second of env.step in the last episode
 
         self.env.reset()
         self.behavior_name      = list(self.env.behavior_specs)[0]
+        behavior_spec           = self.env.behavior_specs[self.behavior_name]
         decision_steps, _       = self.env.get_steps(self.behavior_name)
         self.tracked_agents     = decision_steps.agent_id
 
-        self.policy_memories    = {}
-        self.aux_memories       = AuxMemory()
-        for agent_id in self.tracked_agents:
-            self.policy_memories[agent_id]  = PolicyMemory()
+        self.state_dim          = behavior_spec.observation_shapes[0][0]
+        self.action_dim         = behavior_spec.action_size
+
+        self.aux_memories       = AuxMemory(self.state_dim, n_update * n_aux_update * len(self.tracked_agents) + 1, rss_budget)
+        self.memory             = AgentMemory(self.state_dim, self.action_dim, self.tracked_agents, n_update,
+            self.aux_memories.next_chunk(n_update * len(self.tracked_agents) + 1))
+
+    def merge_steps(self, decisionSteps, terminalSteps):
+        # An agent that ended and already started again is in both, it keeps the terminal reward and done but the new observation
+        agent_ids   = np.concatenate([terminalSteps.agent_id, decisionSteps.agent_id])
+        rewards     = np.concatenate([terminalSteps.reward, decisionSteps.reward])
+        dones       = np.concatenate([~terminalSteps.interrupted, np.zeros(len(decisionSteps.agent_id), dtype = bool)])
+        next_states = np.concatenate([terminalSteps.obs[0], decisionSteps.obs[0]])
+
+        ids, first  = np.unique(agent_ids, return_index = True)
+        _, last     = np.unique(agent_ids[::-1], return_index = True)
+        last        = len(agent_ids) - 1 - last
+
+        return ids, rewards[first], dones[first], next_states[last]
 
     def run_episode(self):
         self.env.reset()
         decisionSteps, _    = self.env.get_steps(self.behavior_name)
 
-        states = {}
-        for agent_id in decisionSteps.agent_id:
-            states[agent_id] = decisionSteps[agent_id].obs[0]
+        state_ids   = decisionSteps.agent_id
+        states      = decisionSteps.obs[0]
         ############################################
         total_reward = 0
         eps_time = 0
+        env_time = 0
         ############################################
         for _ in range(self.n_update * self.n_aux_update):
-            actions = {}
-            for id, state in states.items():
-                actions[id] = self.agent.act(state)
+            # One forward pass for the whole DecisionSteps batch. The outputs stay in the order of state_ids,
+            # which is the order set_actions expects, and save_agents maps them to the agents through it
+            actions, action_means, logprobs, values = [], [], [], []
 
-            if len(actions) > 0:
-                action_gym  = np.stack([value for key, value in actions.items()])
-                self.env.set_actions(self.behavior_name, action_gym)
+            if len(state_ids) > 0:
+                actions, action_means, logprobs, values = self.agent.act(states)
+                self.env.set_actions(self.behavior_name, actions)
 
+            start = time.perf_counter()
             self.env.step()
-            decisionSteps, terminalSteps = self.env.get_steps(self.behavior_name)
+            env_time += time.perf_counter() - start
 
-            rewards = {}
-            dones = {}
-            next_states = {}
-            terminated_states = {}
-
-            for agent_id in decisionSteps.agent_id:
-                rewards[agent_id]       = decisionSteps[agent_id].reward
-                dones[agent_id]         = False
-                next_states[agent_id]   = decisionSteps[agent_id].obs[0]            
-            
-            for agent_id in terminalSteps.agent_id:
-                rewards[agent_id]           = terminalSteps[agent_id].reward
-                dones[agent_id]             = not terminalSteps[agent_id].interrupted
-                terminated_states[agent_id] = terminalSteps[agent_id].obs[0]
+            decisionSteps, terminalSteps = self.env.get_steps(self.behavior_name)
+            next_ids, rewards, dones, next_states = self.merge_steps(decisionSteps, terminalSteps)
 
             eps_time        += 1
             self.t_updates  += 1
-            total_reward    += np.mean([value for key, value in rewards.items()])
+            total_reward    += np.mean(rewards)
                             
             if self.training_mode:
-                for track_agent in self.tracked_agents:
-                    if track_agent in states and track_agent in next_states:
-                        self.policy_memories[track_agent].save_eps(states[track_agent], actions[track_agent].tolist(), rewards[track_agent], float(dones[track_agent]), next_states[track_agent])
-
-                    elif track_agent in states and track_agent in terminated_states:
-                        self.policy_memories[track_agent].save_eps(states[track_agent], actions[track_agent].tolist(), rewards[track_agent], float(dones[track_agent]), terminated_states[track_agent])
+                self.memory.save_agents(state_ids, states, actions, action_means, logprobs, values, next_ids, rewards, dones, next_states)
 
             if self.training_mode and self.t_updates == self.n_update:
                 self.t_aux_updates += 1
                 self.t_updates = 0
-                tempMemory = PolicyMemory()
-                
-                for policy_memory in self.policy_memories.values():
-                    tempstates, tempactions, temprewards, tempdones, tempnext_states = policy_memory.get_all()
-                    tempMemory.save_all(tempstates, tempactions, temprewards, tempdones, tempnext_states)
-                    policy_memory.clear_memory()
 
-                tempMemory, self.aux_memories = self.agent.update_ppo(tempMemory, self.aux_memories)
+                self.memory, self.aux_memories = self.agent.update_ppo(self.memory, self.aux_memories)
                 
                 if self.t_aux_updates == self.n_aux_update:
                     self.t_aux_updates = 0
                     self.aux_memories = self.agent.update_aux(self.aux_memories)
 
-            states      = next_states
-                    
+                    # The whole storage is free again, so the next rollout can be written into it
+                    self.memory.clear_memory(self.aux_memories.next_chunk(self.memory.capacity() + 1))
+
+            state_ids   = decisionSteps.agent_id
+            states      = decisionSteps.obs[0]
+
+        self.steps_per_sec = eps_time / env_time if env_time > 0 else 0.0
         return total_reward, eps_time
 
 def plot(datas):
@@ -501,6 +1217,13 @@ def main():
     batchsize           = 32 # How many batch per update. size of batch = n_update / batchsize. Rocommended set to 4 for Discrete
     PPO_epochs          = 10 # How many epoch per update
     n_aux_update        = 5
+    rss_budget          = None # In bytes. Once the process uses more memory than this the aux states are kept in a temporary file. None keeps them in RAM
+    env_file            = None # Path of a Unity build. None connects to the Editor, which can only run one instance
+    n_envs              = 1 # How many instances of the build run side by side, their agents are trained as one batch
+    headless            = True # While training the simulator runs with the engine settings below and without rendering
+    time_scale          = 20.0 # How many times faster than real time the simulator runs
+    target_frame_rate   = -1 # -1 leaves the frame rate to Unity
+    quality_level       = 0 # The lowest graphics quality, vector observations do not depend on it
     max_action          = 1.0
     
     gamma               = 0.99 # Just set to 0.99
@@ -509,7 +1232,8 @@ def main():
     ############################################# 
     #env_id              = '3DBall'
     #env                = default_registry[env_id].make()
-    env                 = UnityEnvironment(file_name = None, seed = 1)
+    engine_config       = EngineConfig(time_scale, target_frame_rate, quality_level) if training_mode and headless else None
+    env                 = UnityEnvPool(lambda worker_id: make_env(env_file, worker_id, engine_config), n_envs)
 
     env.reset()
     behavior_name       = list(env.behavior_specs)[0]
@@ -526,7 +1250,7 @@ def main():
     agent               = Agent(state_dim, action_dim, training_mode, policy_kl_range, policy_params, value_clip, entropy_coef, vf_loss_coef,
                             batchsize, PPO_epochs, gamma, lam, learning_rate)  
 
-    runner              = Runner(env, agent, render, training_mode, n_update, n_aux_update, max_action)
+    runner              = Runner(env, agent, render, training_mode, n_update, n_aux_update, max_action, rss_budget)
     #############################################     
     if using_google_drive:
         from google.colab import drive
@@ -546,7 +1270,7 @@ def main():
     for i_episode in range(1, n_episode + 1):
         total_reward, time = runner.run_episode()
 
-        print('Episode {} \t t_reward: {} \t time: {} \t '.format(i_episode, total_reward, time))
+        print('Episode {} \t t_reward: {} \t time: {} \t sim steps/s: {:.1f} \t '.format(i_episode, total_reward, time, runner.steps_per_sec))
         batch_rewards.append(int(total_reward))
         batch_times.append(time)        
 